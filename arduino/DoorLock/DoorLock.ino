@@ -64,6 +64,13 @@ static uint32_t last_time_tick;
 #define PING_TIMEOUT 90
 static int ping_ticks;
 
+// Line rate at power on, and after losing contact with the host
+#define DEFAULT_BAUD 9600
+// A rate change is undone unless a ping arrives at the new rate this soon
+#define BAUD_CONFIRM_INTERVAL 2000
+static long current_baud = DEFAULT_BAUD;
+static unsigned long baud_confirm_time;
+
 #define is_alive() (ping_ticks != 0)
 
 unsigned long relock_time;
@@ -76,9 +83,26 @@ static char *pin_pos;
 static bool pin_valid;
 static unsigned long pin_timeout;
 
-#define MAX_MSG_SIZE 32
+// Large enough for several keys in a single MSG_KEY_ADD_MULTI
+#define MAX_MSG_SIZE 128
+// Leaves room for the CRC in a frame of MAX_MSG_SIZE
+#define MAX_DATA_SIZE (MAX_MSG_SIZE - 4)
 static uint8_t msg_buf[MAX_MSG_SIZE];
 static int msg_buf_len;
+static bool msg_buf_overflow;
+
+// Binary framing, see MSG_SET_FRAMING
+#define FRAME_SYNC 0xFE
+static bool binary_mode;
+// Binary receive state: waiting for FRAME_SYNC or the length byte,
+// otherwise the number of bytes still to come
+#define RX_SYNC -2
+#define RX_LENGTH -1
+static int rx_expect = RX_SYNC;
+static uint8_t rx_last;
+
+// Optional protocol features reported by MSG_FEATURES
+#define FEATURES "MDLBW"
 
 // Must be a power of two
 #define LOG_BUF_SIZE 256
@@ -93,7 +117,7 @@ static int log_head;
 uint8_t my_addr = '?';
 
 /* Communication protocol is as follows:
-    RS232, 9600 baud, 8N1
+    RS232, 9600 baud (see MSG_SET_BAUD), 8N1
     5-pin 180deg DIN (same as MIDI), pinout:
       1 - +12V (Red)
       2 - Ground (Black)
@@ -112,6 +136,8 @@ uint8_t my_addr = '?';
       Newline terminator (ascii 0x0A)
 
     Terminator bytes should never appear elsewhere in the frame.
+    Frames (including the CRC) must not exceed 128 bytes.  Longer frames
+    are dropped.
     A host will typically send 'X\n' to force a frame reset.
 
     A device initially has an unassigned address ('?'). With the exception
@@ -133,6 +159,25 @@ uint8_t my_addr = '?';
     CRC16 are calculated using the xmodem algorithm and encoded as 4 hex
     characters (big-endian byte order).
 
+    Binary framing may be used instead once negotiated with
+    MSG_SET_FRAMING:
+      FRAME_SYNC (0xFE)
+      Length byte, counting the message type, address and data bytes
+      Message type character
+      Address character
+      Data bytes (if applicable)
+      CRC16 of the type, address and data bytes (2 bytes, big-endian)
+
+    Frames with a bad CRC are dropped, and the receiver looks for the
+    next FRAME_SYNC.  The data is as for ASCII framing, except that:
+      Timestamps are 4 byte little-endian unix time values.
+      MSG_KEY_HASH data is the 2 byte hash, big-endian.
+      MSG_LOG_GET_BULK entries are each preceded by a length byte
+      instead of being separated by ','.
+      MSG_COMMENT lines are not sent.
+    'X\n' between frames returns the device to ASCII framing, as does
+    90 seconds without a ping.
+
     After sending a command, a host should wait for the response before
     sending annother command.  If a response is not recieved then a
     full device re-enumeration should be performed.
@@ -165,13 +210,47 @@ uint8_t my_addr = '?';
 
     Host to device commands:
 
+      MSG_FEATURES
+	Query optional protocol features.  Older devices do not recognise
+	this command and will pass it through unchanged, which reads as an
+	empty feature list.
+	Data: None
+	Response: MSG_FEATURES, with a list of feature characters:
+	  'M': MSG_KEY_ADD_MULTI is supported
+	  'D': MSG_KEY_DELETE is supported
+	  'L': MSG_LOG_GET_BULK is supported
+	  'B': MSG_SET_BAUD is supported
+	  'W': MSG_SET_FRAMING is supported
+
+      MSG_SET_BAUD
+	Change the line rate.  Only for use with a single device on the
+	port.  The response is sent at the old rate, after which the
+	device switches.  The host must then send a MSG_PING at the new
+	rate within 2 seconds, or the device goes back to 9600 baud.  The
+	device also goes back to 9600 baud if it is not pinged for 90
+	seconds.  Unsupported rates are passed through unchanged.
+	Data: Line rate in decimal: 9600, 19200, 38400, 57600 or 115200
+	Response: MSG_ACK
+
+      MSG_SET_FRAMING
+	Switch between ASCII and binary framing.  The response is sent
+	using the old framing.
+	Data: 'A' for ASCII or 'B' for binary
+	Response: MSG_ACK
+
       MSG_LOG_GET
 	Read the next log entry.
 	Data: None
 	Response: MSG_LOG_VALUE
 
+      MSG_LOG_GET_BULK
+	Read as many of the remaining log entries as fit in one message.
+	Data: None
+	Response: MSG_LOG_VALUE, with the entries separated by ','
+
       MSG_LOG_CLEAR
-	Discard the current log entry.
+	Discard the log entries returned by the last MSG_LOG_GET or
+	MSG_LOG_GET_BULK.
 	Data: None
 	Response: MSG_ACK
 
@@ -187,6 +266,20 @@ uint8_t my_addr = '?';
 	Data: Tag ID followed by space (ascii 0x20) and PIN
 	Response: MSG_ACK
 
+      MSG_KEY_ADD_MULTI
+	Add several access tags at once.  As for MSG_KEY_ADD, but with
+	one or more keys separated by commas (ascii 0x2C).  Only
+	acknowledged once all the keys have been added.
+	Data: Comma separated list of (Tag ID, space, PIN)
+	Response: MSG_ACK
+
+      MSG_KEY_DELETE
+	Revoke one or more tags.  The remaining tags keep their order.
+	Unknown tags are ignored.  As for MSG_KEY_ADD, the host must send
+	a MSG_KEY_INFO to ensure that the change has been committed.
+	Data: Comma separated list of Tag IDs
+	Response: MSG_ACK
+
       MSG_KEY_INFO
 	Calculate the current keyset hash.  This can be used to determine
        	whether a newly enumerated device matches the current access list.
@@ -236,13 +329,14 @@ uint8_t my_addr = '?';
 
       MSG_ACK
 	Indicate successful completion of MSG_LOG_CLEAR, MSG_KEY_RESET,
-	MSG_KEY_ADD, MSG_UNLOCK or MSG_RESET command.
+	MSG_KEY_ADD, MSG_KEY_ADD_MULTI, MSG_KEY_DELETE, MSG_UNLOCK or
+	MSG_RESET command.
 	Data: None
 
       MSG_KEY_HASH
 	The hash of the current keyset.  This is the CRC16 of all
 	previously MSG_ADD_KEY commands, plus a null terminator
-       	after each one.
+       	after each one.  Keys removed by MSG_KEY_DELETE are skipped.
  */
 enum {
     MSG_SET_ADDRESS = 'S',
@@ -250,8 +344,14 @@ enum {
     MSG_COMMENT = '#',
     MSG_LOG_GET = 'G',
     MSG_LOG_CLEAR = 'C',
+    MSG_LOG_GET_BULK = 'L',
+    MSG_SET_BAUD = 'B',
+    MSG_SET_FRAMING = 'W',
     MSG_KEY_RESET = 'R',
     MSG_KEY_ADD = 'N',
+    MSG_KEY_ADD_MULTI = 'M',
+    MSG_KEY_DELETE = 'D',
+    MSG_FEATURES = 'F',
     MSG_KEY_INFO = 'K',
     MSG_UNLOCK = 'U',
     MSG_RESET = 'Z',
@@ -271,7 +371,7 @@ init_rfid(void)
 // the setup routine runs once when you press reset:
 void setup()
 {
-  comSerial.begin(9600);
+  comSerial.begin(DEFAULT_BAUD);
 }
 
 static unsigned long
@@ -344,11 +444,33 @@ send_crc(const uint8_t *msg, int len)
 static void
 send_packet(uint8_t *msg, int len)
 {
+  uint16_t crc;
+
+  if (binary_mode)
+    {
+      crc = calc_crc(msg, len);
+      comSerial.write(FRAME_SYNC);
+      comSerial.write((uint8_t)len);
+      comSerial.write(msg, len);
+      comSerial.write(crc >> 8);
+      comSerial.write(crc & 0xff);
+      return;
+    }
   comSerial.write(msg, len);
   send_crc(msg, len);
   comSerial.write('\n');
 }
 
+/* Debug messages.  Not sent in binary mode.  */
+static void
+send_comment(const char *msg)
+{
+  if (binary_mode)
+    return;
+  comSerial.print("# ");
+  comSerial.println(msg);
+}
+
 static char encode64(int val)
 {
   if (val < 26)
@@ -409,6 +531,19 @@ set_time(uint8_t *msg)
   current_time = t;
 }
 
+static void
+set_time_raw(uint8_t *msg)
+{
+  int i;
+  uint32_t t;
+
+  t = 0;
+  for (i = 0; i < 4; i++)
+    t |= (uint32_t)msg[i] << (i * 8);
+
+  current_time = t;
+}
+
 static void
 log_tag(char action)
 {
@@ -506,11 +641,61 @@ lock_door(void)
   digitalWrite(LOCK_PIN, LOCK_OFF);
 }
 
+/* Copy the next log entry to msg_buf at offset i.  Returns the new
+   offset, or -1 if the entry does not fit in MAX_DATA_SIZE.  In binary
+   mode the timestamp is sent as 4 raw bytes.  */
+static int
+pop_log_entry(int i)
+{
+  char c;
+  int n;
+  uint32_t t;
+
+  if (binary_mode)
+    {
+      t = 0;
+      for (n = 0; n < 6 && log_head != log_tail; n++)
+	t |= (uint32_t)decode64(log_pop()) << (n * 6);
+      if (i + 4 > MAX_DATA_SIZE)
+	return -1;
+      for (n = 0; n < 4; n++)
+	{
+	  msg_buf[i++] = t & 0xff;
+	  t >>= 8;
+	}
+    }
+  while (log_head != log_tail)
+    {
+      c = log_pop();
+      if (c == 0)
+	break;
+      if (i == MAX_DATA_SIZE)
+	return -1;
+      msg_buf[i++] = c;
+    }
+  return i;
+}
+
 static void
 send_log_packet(void)
 {
   int i;
-  char c;
+
+  msg_buf[0] = MSG_LOG_VALUE;
+  msg_buf[1] = my_addr;
+  i = 2;
+  log_tail = log_ack_tail;
+  if (log_head != log_tail)
+    i = pop_log_entry(i);
+  send_packet(msg_buf, i);
+}
+
+static void
+send_log_bulk(void)
+{
+  int i;
+  int rec_start;
+  int rec_tail;
 
   msg_buf[0] = MSG_LOG_VALUE;
   msg_buf[1] = my_addr;
@@ -518,10 +703,27 @@ send_log_packet(void)
   log_tail = log_ack_tail;
   while (log_head != log_tail)
     {
-      c = log_pop();
-      if (c == 0)
-	break;
-      msg_buf[i++] = c;
+      rec_start = i;
+      rec_tail = log_tail;
+      // Room for the separator or length byte
+      if (binary_mode || i != 2)
+	{
+	  if (i == MAX_DATA_SIZE)
+	    break;
+	  i++;
+	}
+      i = pop_log_entry(i);
+      if (i < 0)
+	{
+	  // Leave this entry for the next message
+	  i = rec_start;
+	  log_tail = rec_tail;
+	  break;
+	}
+      if (binary_mode)
+	msg_buf[rec_start] = i - rec_start - 1;
+      else if (rec_start != 2)
+	msg_buf[rec_start] = ',';
     }
   send_packet(msg_buf, i);
 }
@@ -542,6 +744,16 @@ key_info(void)
     msg_buf[0] = MSG_KEY_HASH;
     msg_buf[1] = my_addr;
     crc = get_tag_hash();
+    if (binary_mode)
+      {
+	msg_buf[2] = crc >> 8;
+	msg_buf[3] = crc & 0xff;
+	send_packet(msg_buf, 4);
+	return;
+      }
+    comSerial.print("# ");
+    comSerial.print(get_tag_free());
+    comSerial.println(" bytes EEPROM free");
     write_hex8((char *)msg_buf + 2, crc >> 8);
     write_hex8((char *)msg_buf + 4, crc & 0xff);
     send_packet(msg_buf, 6);
@@ -572,16 +784,126 @@ do_add_key(uint8_t *msg, int len)
     const char *err;
     err = add_tag(msg, len);
     if (err) {
-        Serial.print("# ");
-        Serial.println(err);
+        send_comment(err);
     } else {
         send_ack();
     }
 }
 
+static void
+do_add_keys(uint8_t *msg, int len)
+{
+    const char *err;
+    int n;
+
+    while (len > 0) {
+        for (n = 0; n < len && msg[n] != ','; n++) {
+            /* No-op */
+        }
+        err = add_tag(msg, n);
+        if (err) {
+            send_comment(err);
+            return;
+        }
+        n++;
+        msg += n;
+        len -= n;
+    }
+    send_ack();
+}
+
+static void
+do_delete_keys(uint8_t *msg, int len)
+{
+    const char *err;
+    int n;
+
+    while (len > 0) {
+        for (n = 0; n < len && msg[n] != ','; n++) {
+            /* No-op */
+        }
+        err = delete_tag(msg, n);
+        if (err) {
+            send_comment(err);
+            return;
+        }
+        n++;
+        msg += n;
+        len -= n;
+    }
+    send_ack();
+}
+
+static void
+set_baud(long baud)
+{
+  // Let the last response go out at the old rate
+  comSerial.flush();
+  comSerial.begin(baud);
+  current_baud = baud;
+}
+
+/* Returns false for unsupported rates.  */
+static bool
+baud_cmd(uint8_t *msg, int len)
+{
+  long baud;
+  int i;
+
+  baud = 0;
+  for (i = 0; i < len; i++)
+    {
+      if (msg[i] < '0' || msg[i] > '9')
+	return false;
+      baud = baud * 10 + msg[i] - '0';
+    }
+  switch (baud)
+    {
+    case 9600:
+    case 19200:
+    case 38400:
+    case 57600:
+    case 115200:
+      break;
+    default:
+      return false;
+    }
+  send_ack();
+  set_baud(baud);
+  if (baud == DEFAULT_BAUD)
+    baud_confirm_time = 0;
+  else
+    baud_confirm_time = now_plus(BAUD_CONFIRM_INTERVAL);
+  return true;
+}
+
+static void
+set_framing(bool binary)
+{
+  binary_mode = binary;
+  msg_buf_len = 0;
+  msg_buf_overflow = false;
+  rx_expect = RX_SYNC;
+  rx_last = 0;
+}
+
+static void
+send_features(void)
+{
+  int len;
+
+  msg_buf[0] = MSG_FEATURES;
+  msg_buf[1] = my_addr;
+  len = strlen(FEATURES);
+  memcpy(msg_buf + 2, FEATURES, len);
+  send_packet(msg_buf, len + 2);
+}
+
 static void
 process_msg(uint8_t *msg, int len)
 {
+  char c;
+
   if (msg[0] == MSG_SET_ADDRESS)
     {
       my_addr = msg[1];
@@ -594,9 +916,12 @@ process_msg(uint8_t *msg, int len)
       else
 	{
 	  msg[1]++;
-	  if (len == 8)
+	  if (binary_mode && len == 6)
+	    set_time_raw(msg + 2);
+	  else if (!binary_mode && len == 8)
 	    set_time(msg + 2);
 	  ping_ticks = PING_TIMEOUT;
+	  baud_confirm_time = 0;
 	}
     }
   else if (msg[0] != MSG_COMMENT)
@@ -616,6 +941,11 @@ process_msg(uint8_t *msg, int len)
 	    break;
 	  send_log_packet();
 	  return;
+	case MSG_LOG_GET_BULK:
+	  if (len != 2)
+	    break;
+	  send_log_bulk();
+	  return;
 	case MSG_KEY_RESET:
 	  if (len != 2)
 	    return;
@@ -627,6 +957,28 @@ process_msg(uint8_t *msg, int len)
 	    return;
 	  do_add_key(msg + 2, len - 2);
 	  return;
+	case MSG_KEY_ADD_MULTI:
+	  do_add_keys(msg + 2, len - 2);
+	  return;
+	case MSG_KEY_DELETE:
+	  do_delete_keys(msg + 2, len - 2);
+	  return;
+	case MSG_FEATURES:
+	  if (len != 2)
+	    return;
+	  send_features();
+	  return;
+	case MSG_SET_BAUD:
+	  if (baud_cmd(msg + 2, len - 2))
+	    return;
+	  break;
+	case MSG_SET_FRAMING:
+	  if (len != 3 || (msg[2] != 'A' && msg[2] != 'B'))
+	    break;
+	  c = msg[2];
+	  send_ack();
+	  set_framing(c == 'B');
+	  return;
 	case MSG_KEY_INFO:
 	  if (len != 2)
 	    return;
@@ -660,6 +1012,40 @@ is_terminator(char c)
   return (c == '\n' || c == '\r');
 }
 
+static void
+rx_binary(uint8_t c)
+{
+  uint16_t crc;
+
+  if (rx_expect == RX_SYNC)
+    {
+      if (c == '\n' && rx_last == 'X')
+	set_framing(false);
+      else if (c == FRAME_SYNC)
+	rx_expect = RX_LENGTH;
+      rx_last = c;
+      return;
+    }
+  if (rx_expect == RX_LENGTH)
+    {
+      if (c < 2 || c > MAX_MSG_SIZE - 2)
+	rx_expect = RX_SYNC;
+      else
+	rx_expect = c + 2;
+      msg_buf_len = 0;
+      return;
+    }
+  msg_buf[msg_buf_len++] = c;
+  if (msg_buf_len < rx_expect)
+    return;
+  rx_expect = RX_SYNC;
+  rx_last = 0;
+  crc = ((uint16_t)msg_buf[msg_buf_len - 2] << 8) | msg_buf[msg_buf_len - 1];
+  if (crc == calc_crc(msg_buf, msg_buf_len - 2))
+    process_msg(msg_buf, msg_buf_len - 2);
+  msg_buf_len = 0;
+}
+
 static void
 do_serial(void)
 {
@@ -669,9 +1055,11 @@ do_serial(void)
   while (comSerial.available())
     {
       c = comSerial.read();
-      if (is_terminator(c))
+      if (binary_mode)
+	rx_binary(c);
+      else if (is_terminator(c))
 	{
-	  if (msg_buf_len >= 6)
+	  if (msg_buf_len >= 6 && !msg_buf_overflow)
 	    {
 	      if (!verify_crc(msg_buf, msg_buf_len))
                 {
@@ -679,9 +1067,12 @@ do_serial(void)
                 }
 	    }
 	  msg_buf_len = 0;
+	  msg_buf_overflow = false;
 	}
-      else
+      else if (msg_buf_len < MAX_MSG_SIZE)
 	msg_buf[msg_buf_len++] = c;
+      else
+	msg_buf_overflow = true;
     }
   if (seen_event)
     {
@@ -765,6 +1156,12 @@ do_timer(void)
   if (time_after(green_time))
     green_time = 0;
 
+  if (time_after(baud_confirm_time))
+    {
+      baud_confirm_time = 0;
+      set_baud(DEFAULT_BAUD);
+    }
+
 #ifdef RFID2_CS_PIN
   if (time_after(scanout_time))
     scanout_time = 0;
@@ -797,7 +1194,13 @@ do_timer(void)
       last_time_tick += 1000;
       current_time++;
       if (ping_ticks > 0)
-	ping_ticks--;
+	{
+	  ping_ticks--;
+	  if (ping_ticks == 0 && current_baud != DEFAULT_BAUD)
+	    set_baud(DEFAULT_BAUD);
+	  if (ping_ticks == 0 && binary_mode)
+	    set_framing(false);
+	}
     }
 
   if (status_timeout == 0 || time_after(status_timeout))
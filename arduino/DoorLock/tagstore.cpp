@@ -134,11 +134,16 @@ eeprom_flush(void)
 #define EEPROM_VERSION_OFFSET 63
 #define TAG_VERSION_ID 1
 #define EEPROM_TAG_START 64
+// Set in the length byte of deleted tags.  The space is reclaimed by the
+// next reset_keys().
+#define TAG_DELETED 0x80
 static char eeprom_tag_id[MAX_TAG_LEN + 1];
 static char eeprom_tag_pin[MAX_TAG_LEN + 1];
 
 static int eeprom_offset;
 static int eeprom_last_offset;
+// Start of the most recently read tag
+static int eeprom_tag_offset;
 
 static void
 eeprom_rewind()
@@ -158,13 +163,21 @@ eeprom_read_tag()
     if (eeprom_offset < 0) {
         goto fail;
     }
-    len = eeprom_read(eeprom_offset);
-    if (len == 0xff) {
-        goto fail;
-    }
-    if (eeprom_offset + len + 5 > EEPROM_TAG_END) {
-        goto fail;
+    while (true) {
+        len = eeprom_read(eeprom_offset);
+        if (len == 0xff) {
+            goto fail;
+        }
+        if (eeprom_offset + (len & ~TAG_DELETED) + 5 > EEPROM_TAG_END) {
+            goto fail;
+        }
+        if ((len & TAG_DELETED) == 0) {
+            break;
+        }
+        // Skip deleted tags
+        eeprom_offset += (len & ~TAG_DELETED) + 5;
     }
+    eeprom_tag_offset = eeprom_offset;
     eeprom_offset++;
 
     p = eeprom_tag_id;
@@ -258,6 +271,27 @@ add_tag(uint8_t *key, int len)
     return NULL;
 }
 
+const char *
+delete_tag(uint8_t *key, int len)
+{
+    char tag[9];
+
+    // Tags that could never have been added are not an error
+    if (len != 8) {
+        return NULL;
+    }
+    memcpy(tag, key, 8);
+    tag[8] = 0;
+    eeprom_rewind();
+    while (eeprom_read_tag()) {
+        if (strcmp(tag, eeprom_tag_id) == 0) {
+            eeprom_write(eeprom_tag_offset,
+                         eeprom_read(eeprom_tag_offset) | TAG_DELETED);
+        }
+    }
+    return NULL;
+}
+
 uint16_t
 get_tag_hash(void)
 {
@@ -272,12 +306,16 @@ get_tag_hash(void)
         crc = crc_string(crc, eeprom_tag_pin);
         crc = _crc_xmodem_update(crc, 0);
     }
-    Serial.print("# ");
-    Serial.print(EEPROM_TAG_END - eeprom_last_offset);
-    Serial.println(" bytes EEPROM free");
     return crc;
 }
 
+/* Only valid after get_tag_hash().  */
+int
+get_tag_free(void)
+{
+    return EEPROM_TAG_END - eeprom_last_offset;
+}
+
 /* Returns false if not found.  */
 bool
 find_tag(const char *tag, char *pin)
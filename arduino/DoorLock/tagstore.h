@@ -6,7 +6,10 @@
 void reset_keys(void);
 void init_keys(void);
 const char *add_tag(uint8_t *key, int len);
+const char *delete_tag(uint8_t *key, int len);
 uint16_t get_tag_hash(void);
+/* Bytes of tag storage left.  Only valid after get_tag_hash().  */
+int get_tag_free(void);
 /* Returns false if not found.  */
 bool find_tag(const char *tag, char *pin);
 
@@ -25,6 +25,11 @@
 #define BELL_OFF 0
 #define BELL_ON 1
 
+// Line rate at reset.  A rate change with 'R' is undone unless a '?'
+// arrives at the new rate within BAUD_CONFIRM_INTERVAL ms.
+#define DEFAULT_BAUD 9600
+#define BAUD_CONFIRM_INTERVAL 2000
+
 char input[10];
 char last;
 int count;
@@ -32,6 +37,7 @@ Servo pan;
 int panangle=90;
 bool seen_ping;
 unsigned long bell_timer;
+unsigned long baud_timer;
 
 void Write (void) {
   pinMode(9, OUTPUT);     
@@ -132,6 +138,13 @@ int ReadTemp(void)
   return temperature-1; //return measured temperature
 }
 
+void SetBaud (long baud)
+{
+  // Let the last response go out at the old rate
+  Serial.flush();
+  Serial.begin(baud);
+};
+
 void FireLaser (int pulses)
 {
   for (int pulse=0;pulse<=pulses;pulse++)
@@ -162,7 +175,7 @@ void setup()
   FireLaser(10);
   pan.attach(PANSERVO);
   pan.write(panangle);
-  Serial.begin(9600);
+  Serial.begin(DEFAULT_BAUD);
   Wire.begin(0x00);
   count=0;
 }
@@ -170,6 +183,7 @@ void setup()
 void loop()                     
 { 
   long delta;
+  long baud;
   if (bell_timer) {
     delta = bell_timer - millis();
     if (delta < 0) {
@@ -177,6 +191,13 @@ void loop()
       bell_timer = 0;
     }
   }
+  if (baud_timer) {
+    delta = baud_timer - millis();
+    if (delta < 0) {
+      SetBaud(DEFAULT_BAUD);
+      baud_timer = 0;
+    }
+  }
   if (Serial.available() > 0)
   {
     last=Serial.read();
@@ -282,12 +303,27 @@ void loop()
       bell_timer = atoi(&input[1])*1000+millis();
 	  Serial.println("OK");
 	  break;
+	case 'R': //Line rate
+	  baud = atol(&input[1]);
+	  if (baud == 9600 || baud == 19200 || baud == 38400
+	      || baud == 57600 || baud == 115200) {
+	    Serial.println("OK");
+	    SetBaud(baud);
+	    if (baud == DEFAULT_BAUD)
+	      baud_timer = 0;
+	    else
+	      baud_timer = millis() + BAUD_CONFIRM_INTERVAL;
+	  } else {
+	    Serial.println("ERR");
+	  }
+	  break;
 	case 'X':
 	  /* Ignore/reset.  */
 	  break;
 	case '?':
 	  if (input[1] == 0) {
-	    Serial.print("Marvin 1.5");
+	    baud_timer = 0;
+	    Serial.print("Marvin 1.6");
 	    if (!seen_ping) {
 	      Serial.print("+");
 	      seen_ping = true;
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Compare the speed of the CRC16 implementations.
+
+Run from the top of the repository:
+    python -m crc16.bench
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from crc16 import crc16pure
+from crc16 import crc16fast
+try:
+    from crc16 import _crc16
+except ImportError:
+    _crc16 = None
+
+# (description, data, iterations)
+INPUTS = [
+    ("ping frame (10 bytes)", b"P0AbCdEf", 20000),
+    ("key frame (20 bytes)", b"N0DEADBEEF 1234", 20000),
+    ("full frame (124 bytes)", b"M0" + b"DEADBEEF 1234," * 8 + b"x" * 10, 5000),
+    ("1 MiB", b"\x5a\xa5" * (512 * 1024), 3),
+    ("4 MiB", b"\x5a\xa5" * (2 * 1024 * 1024), 1),
+]
+
+
+def implementations():
+    impls = [("pure", crc16pure), ("optimised", crc16fast)]
+    if _crc16 is not None:
+        impls.append(("C", _crc16))
+    return impls
+
+
+def bench(fn, data, number):
+    times = timeit.repeat(lambda: fn(data), number=number, repeat=3)
+    return min(times) / number
+
+
+def main():
+    impls = implementations()
+    print("%-24s" % "input" + "".join("%20s" % name for name, _ in impls))
+    # Build the word table outside the timed runs
+    crc16fast.crc16xmodem(b"\0" * crc16fast.WORD_THRESHOLD)
+    for desc, data, number in INPUTS:
+        row = "%-24s" % desc
+        for name, module in impls:
+            t = bench(module.crc16xmodem, data, number)
+            if len(data) < 1024:
+                row += "%17.2fus" % (t * 1e6)
+            else:
+                row += "%15.1fMB/s" % (len(data) / t / 1e6)
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Optimised pure python library for calculating CRC16"""
+
+##############################################################################
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import array
+import sys
+
+from .crc16pure import CRC16_XMODEM_TABLE
+
+
+# The CRC table is linear (T[a ^ b] == T[a] ^ T[b]), so two input bytes
+# `a` and `b` can be folded into the CRC with one loop iteration:
+#   crc = TABLE2[(crc >> 8) ^ a] ^ TABLE[(crc & 0xff) ^ b]
+CRC16_XMODEM_TABLE2 = [((CRC16_XMODEM_TABLE[i] & 0xff) << 8)
+                       ^ CRC16_XMODEM_TABLE[CRC16_XMODEM_TABLE[i] >> 8]
+                       for i in range(256)]
+
+# Inputs at least this long are processed as big-endian 16-bit words
+# using a 64k entry table, which is built on first use.
+WORD_THRESHOLD = 256
+
+_word_table = None
+
+
+def _get_word_table():
+    """Return the 64k entry table for processing 16-bit words:
+       crc = WORD_TABLE[crc ^ word]
+    """
+    global _word_table
+    if _word_table is None:
+        table = CRC16_XMODEM_TABLE
+        table2 = CRC16_XMODEM_TABLE2
+        _word_table = [table2[i >> 8] ^ table[i & 0xff] for i in range(65536)]
+    return _word_table
+
+
+def _crc16_bytes(data, crc):
+    """Calculate CRC16 of a bytearray two bytes at a time."""
+    table = CRC16_XMODEM_TABLE
+    table2 = CRC16_XMODEM_TABLE2
+    n = len(data) & ~1
+    for i in range(0, n, 2):
+        crc = table2[(crc >> 8) ^ data[i]] ^ table[(crc & 0xff) ^ data[i + 1]]
+    if n != len(data):
+        crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ data[n]]
+    return crc
+
+
+def _crc16_words(data, crc):
+    """Calculate CRC16 of a large buffer as 16-bit words."""
+    view = memoryview(data)
+    n = len(view) & ~1
+    words = array.array('H')
+    if hasattr(words, 'frombytes'):
+        words.frombytes(view[:n])
+    else:
+        words.fromstring(view[:n].tobytes())
+    if sys.byteorder == 'little':
+        words.byteswap()
+    table = _get_word_table()
+    for word in words:
+        crc = table[crc ^ word]
+    if n != len(view):
+        crc = _crc16_bytes(bytearray(view[n:]), crc)
+    return crc
+
+
+def crc16xmodem(data, crc=0):
+    """Calculate CRC-CCITT (XModem) variant of CRC16.
+    `data`      - data for calculating CRC, a byte string, bytearray
+                  or memoryview
+    `crc`       - initial value
+    Return calculated value of CRC
+    """
+    if len(data) >= WORD_THRESHOLD:
+        return _crc16_words(data, crc & 0xffff)
+    # Inlined copy of _crc16_bytes(), as most callers pass short frames
+    data = bytearray(data)
+    crc &= 0xffff
+    table = CRC16_XMODEM_TABLE
+    table2 = CRC16_XMODEM_TABLE2
+    n = len(data) & ~1
+    for i in range(0, n, 2):
+        crc = table2[(crc >> 8) ^ data[i]] ^ table[(crc & 0xff) ^ data[i + 1]]
+    if n != len(data):
+        crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ data[n]]
+    return crc
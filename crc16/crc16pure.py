@@ -71,19 +71,19 @@ CRC16_XMODEM_TABLE = [
 
 def _crc16(data, crc, table):
     """Calculate CRC16 using the given table.
-    `data`      - data for calculating CRC, must be a string
+    `data`      - data for calculating CRC, must be a byte string
     `crc`       - initial value
     `table`     - table for caclulating CRC (list of 256 integers)
     Return calculated value of CRC
     """
-    for byte in data:
-        crc = ((crc<<8)&0xff00) ^ table[((crc>>8)&0xff)^ord(byte)]
+    for byte in bytearray(data):
+        crc = ((crc<<8)&0xff00) ^ table[((crc>>8)&0xff)^byte]
     return crc & 0xffff
 
 
 def crc16xmodem(data, crc=0):
     """Calculate CRC-CCITT (XModem) variant of CRC16.
-    `data`      - data for calculating CRC, must be a string
+    `data`      - data for calculating CRC, must be a byte string
     `crc`       - initial value
     Return calculated value of CRC
     """
@@ -19,9 +19,14 @@
 #
 ##############################################################################
 
-from crc16 import _crc16
+try:
+    from crc16 import _crc16
+except ImportError:
+    _crc16 = None
 from crc16 import crc16pure
+from crc16 import crc16fast
 import crc16
+import random
 import unittest
 
 class TestCRC16XModem(unittest.TestCase):
@@ -33,23 +38,23 @@ class TestCRC16XModem(unittest.TestCase):
         """Test basic functionality.
         """
         # very basic example
-        self.assertEqual(module.crc16xmodem('123456789'), 0x31c3)
-        self.assertNotEqual(module.crc16xmodem('123456'), 0x31c3)
+        self.assertEqual(module.crc16xmodem(b'123456789'), 0x31c3)
+        self.assertNotEqual(module.crc16xmodem(b'123456'), 0x31c3)
 
         # the same in two steps
-        crc = module.crc16xmodem('12345')
-        crc = module.crc16xmodem('6789', crc)
+        crc = module.crc16xmodem(b'12345')
+        crc = module.crc16xmodem(b'6789', crc)
         self.assertEqual(crc, 0x31C3)
 
         # more basic checks
-        self.assertEqual(module.crc16xmodem('AAAAAAAAAAAAAAAAAAAAAA'), 0x92cd)
+        self.assertEqual(module.crc16xmodem(b'AAAAAAAAAAAAAAAAAAAAAA'), 0x92cd)
 
         # bigger chunks
-        self.assertEqual(module.crc16xmodem('A' * 4096), 0xd694)
-        self.assertEqual(module.crc16xmodem('A' * 39999), 0xcfbb)
+        self.assertEqual(module.crc16xmodem(b'A' * 4096), 0xd694)
+        self.assertEqual(module.crc16xmodem(b'A' * 39999), 0xcfbb)
 
         # test when there are no data
-        self.assertEqual(module.crc16xmodem(''), 0)
+        self.assertEqual(module.crc16xmodem(b''), 0)
 
 
     def test_basics(self):
@@ -58,6 +63,7 @@ class TestCRC16XModem(unittest.TestCase):
         self.doBasics(crc16)
 
 
+    @unittest.skipIf(_crc16 is None, "extension module not built")
     def test_basics_c(self):
         """Test basic functionality of the extension module.
         """
@@ -70,11 +76,53 @@ class TestCRC16XModem(unittest.TestCase):
         self.doBasics(crc16pure)
 
 
+    def test_basics_fast(self):
+        """Test basic functionality of the optimised pure module.
+        """
+        self.doBasics(crc16fast)
+
+
+    def test_buffer_types(self):
+        """Test the pure modules with bytearray and memoryview input.
+        """
+        for module in (crc16pure, crc16fast):
+            for data in (b'123456789', b'A' * 4097):
+                expected = module.crc16xmodem(data)
+                self.assertEqual(module.crc16xmodem(bytearray(data)), expected)
+                self.assertEqual(module.crc16xmodem(memoryview(data)), expected)
+
+
+    def test_fast_matches_pure(self):
+        """Compare the optimised module with the pure one for odd and even
+        lengths either side of the word threshold, with chained CRCs.
+        """
+        rand = random.Random(1234)
+        lengths = list(range(0, 20)) + [crc16fast.WORD_THRESHOLD - 1,
+                crc16fast.WORD_THRESHOLD, crc16fast.WORD_THRESHOLD + 1, 1001]
+        for length in lengths:
+            data = bytearray(rand.randrange(256) for i in range(length))
+            init = rand.randrange(65536)
+            self.assertEqual(crc16fast.crc16xmodem(data, init),
+                    crc16pure.crc16xmodem(data, init))
+            split = length // 3
+            crc = crc16fast.crc16xmodem(data[:split], init)
+            crc = crc16fast.crc16xmodem(data[split:], crc)
+            self.assertEqual(crc, crc16pure.crc16xmodem(data, init))
+
+
+    @unittest.skipIf(_crc16 is None, "extension module not built")
     def test_big_chunks(self):
         """Test calculation of CRC on big chunks of data.
         Test only the extension module becase the pure one will work very long for these tests.
         """
-        self.assertEqual(_crc16.crc16xmodem('A' * 16 * 1024 * 1024), 0xbf75)
+        self.assertEqual(_crc16.crc16xmodem(b'A' * 16 * 1024 * 1024), 0xbf75)
+
+
+    def test_big_chunks_fast(self):
+        """Test calculation of CRC on big chunks of data with the optimised
+        pure module.
+        """
+        self.assertEqual(crc16fast.crc16xmodem(b'A' * 16 * 1024 * 1024), 0xbf75)
 
 
 if __name__ == '__main__':
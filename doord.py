@@ -28,12 +28,26 @@ import socket
 import subprocess
 import fcntl
 import traceback
+import Queue
+import heapq
+import itertools
+import select
+import errno
+import struct
+import collections
+import marshal
+import mmap
+import bisect
+import BaseHTTPServer
 
 def schedule(fn, *args, **kwargs):
-    g.schedule(fn, *args, **kwargs)
+    return g.schedule(fn, *args, **kwargs)
+
+def schedule_once(fn, *args, **kwargs):
+    return g.schedule_once(fn, *args, **kwargs)
 
 def OpenSerial(dev):
-    ser = serial.Serial(dev, 9600, timeout=SERIAL_POLL_PERIOD, writeTimeout=SERIAL_POLL_PERIOD)
+    ser = serial.Serial(dev, SERIAL_BAUD, timeout=SERIAL_POLL_PERIOD, writeTimeout=SERIAL_POLL_PERIOD)
     try:
         fcntl.flock(ser, fcntl.LOCK_EX | fcntl.LOCK_NB)
     except:
@@ -50,6 +64,32 @@ def CloseSerial(ser):
         pass
     ser.close()
 
+# Line rate to negotiate for a serial port.  failed is the time of the
+# last error at a higher rate.
+def want_baud(config, port, failed):
+    if not config.has_option("serial", port):
+        return SERIAL_BAUD
+    if failed + SERIAL_BAUD_RETRY > time.time():
+        return SERIAL_BAUD
+    baud = config.getint("serial", port)
+    if baud not in SERIAL_BAUDS:
+        dbg("%s: Unsupported baud rate %d" % (port, baud))
+        return SERIAL_BAUD
+    return baud
+
+# Whether to negotiate binary framing with a door lock.  failed is the
+# time of the last error using binary framing.
+def want_binary(config, port, failed):
+    if not config.has_option("framing", port):
+        return False
+    if failed + SERIAL_BAUD_RETRY > time.time():
+        return False
+    framing = config.get("framing", port)
+    if framing not in ("ascii", "binary"):
+        dbg("%s: Unsupported framing %s" % (port, framing))
+        return False
+    return framing == "binary"
+
 class PidFile(object):
     """Context manager that locks a pid file.  Implemented as class
     not generator because daemon.py is calling .__exit__() with no parameters
@@ -79,12 +119,86 @@ class PidFile(object):
         os.remove(self.path)
 
 SERIAL_PING_INTERVAL = 60
+# Devices start at SERIAL_BAUD.  A higher rate from the [serial] section
+# of the config is negotiated once the device has answered.
+SERIAL_BAUD = 9600
+SERIAL_BAUDS = (9600, 19200, 38400, 57600, 115200)
+# After errors at a higher rate, or with binary framing, stay at
+# SERIAL_BAUD and ASCII framing for this long
+SERIAL_BAUD_RETRY = 60 * 60
+# Devices go back to SERIAL_BAUD unless they hear from us this soon
+# after a rate change
+SERIAL_BAUD_CONFIRM = 2
+# Marvin firmware versions we can talk to, and the first that can
+# change rate
+MARVIN_VERSIONS = ("Marvin 1.5", "Marvin 1.6")
+MARVIN_BAUD_VERSION = "Marvin 1.6"
+# Marvin is only asked for its version if it has not answered anything
+# for this long.  The temperature is read every minute, so a reset is
+# still noticed within a minute or so.
+MARVIN_QUERY_INTERVAL = 30
 # Polling period is also serial read timeout
 SERIAL_POLL_PERIOD = 5
+# Largest frame (including CRC) accepted by the door lock firmware
+DOOR_MAX_FRAME = 128
 
 DB_POLL_PERIOD = 20
+# Maximum number of idle database connections kept open
+DB_POOL_SIZE = 3
+# Pooled connections are recycled after this many seconds
+DB_MAX_AGE = 30 * 60
+# Security log and temperature rows are written in batches of up to
+# DB_BATCH_SIZE, or after DB_BATCH_DELAY seconds
+DB_BATCH_SIZE = 50
+DB_BATCH_DELAY = 2
+# Writes that fail because the database is unavailable are kept here
+# until they can be replayed
+DB_JOURNAL_FILE = "/var/lib/doord/journal"
+DB_JOURNAL_MAX = 4 * 1024 * 1024
+batch_inserts = {
+    "security" : "INSERT INTO security (time, message) VALUES (%s, %s)",
+    "environmental" :
+        "INSERT INTO environmental (time, temperature) VALUES (%s, %s)",
+}
+# poll_tags only re-reads the tag tables when these SHOW TABLE STATUS
+# columns change
+TAG_STATUS_COLUMNS = ("Name", "Rows", "Data_length", "Auto_increment",
+        "Update_time", "Checksum")
+# query_override goes to the database if the in-memory copies of
+# member tags and open days are older than this
+AUTH_MAX_AGE = 3 * DB_POLL_PERIOD
+# An OTP code that does not match triggers a refresh of the cached codes
+# if they are older than this
+OTP_MISS_REFRESH = 5
+# Matching an OTP code extends its life by this much
+OTP_EXTEND = 10 * 60
+
+MPD_HOST = "wifihifi"
+MPD_PORT = 6600
+MPD_TIMEOUT = 10
+# mpc command names that differ from the MPD protocol.  mpc's "volume"
+# is MPD's "setvol", except for relative changes (see mpd_relative).
+mpc_commands = {"prev" : "previous", "pause" : "pause 1",
+        "toggle" : "pause"}
+# Only the last of these pending commands is sent
+mpd_playback = ("play", "stop", "pause")
+# Only the last pending copy of each of these is sent, except for
+# relative volume changes.  Anything else (next, prev, toggle) is sent as
+# many times as it was queued.
+mpd_replace = ("volume", "setvol", "seek", "repeat", "random")
 
 IRC_TIMEOUT = 30
+# Keyed IRC messages are held this long so that only the last of a burst
+# is sent
+IRC_COALESCE_WINDOW = 5
+# At most IRC_RATE messages a second, with bursts of up to IRC_RATE_BURST
+IRC_RATE = 1.0
+IRC_RATE_BURST = 5
+# Oldest messages are dropped beyond this
+IRC_QUEUE_SIZE = 100
+IRC_IDLE_TIMEOUT = 5 * 60
+IRC_BACKOFF_MIN = 1
+IRC_BACKOFF_MAX = 60
 
 ARP_SCAN_INTERVAL = 60
 # RFID tags keep the space open for 15 minutes
@@ -92,26 +206,155 @@ RFID_SCAN_LIFETIME = 15 * 60
 # Also keep network devices for 15 minutes, so rebooting a machine doesn't
 # cause it to disappear
 ARP_LIFETIME = 15 * 60
-
-debug_lock = threading.Lock()
+# Network device deadlines are only rewritten once they have less than
+# this long left, rather than on every scan
+ARP_EXTEND_BELOW = ARP_LIFETIME - 5 * 60
+# Hosts that drop out of the ARP table are pinged, this many at once
+ARP_PROBE_WORKERS = 8
+ARP_PROBE_TIMEOUT = 5
+
+# rtnetlink neighbour table notifications, from linux/rtnetlink.h
+# and linux/neighbour.h
+NETLINK_ROUTE = 0
+RTMGRP_NEIGH = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+NUD_VALID = 0xde
+# struct nlmsghdr and struct ndmsg
+NLMSG_HDR = "=LHHLL"
+NLMSG_HDR_LEN = 16
+NDMSG = "=BxxxiHBB"
+NDMSG_LEN = 12
+
+# Upper bounds (seconds) of latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0)
+
+LOG_FILE = "/var/log/doord.log"
+# Messages queued beyond this are dropped rather than block the caller
+LOG_QUEUE_SIZE = 1000
+# Check whether logrotate has moved the log file at most this often
+LOG_REOPEN_CHECK = 5
+
+# Log levels
+LOG_INFO = 0
+LOG_DEBUG = 1
+# Serial protocol and dispatcher chatter.  Callers on hot paths should
+# check log_level before formatting these messages.
+LOG_TRACE = 2
+log_levels = {"info" : LOG_INFO, "debug" : LOG_DEBUG, "trace" : LOG_TRACE}
+
+do_debug = False
+log_level = LOG_DEBUG
+log_writer = None
 
 port_door_map = {"door_up" : "internaldoor",
         "door_down" : "externaldoor"};
 
-def dbg(msg):
+def dbg(msg, level=LOG_DEBUG):
+    if level > log_level:
+        return
     if do_debug:
         print msg
-    tstr = time.strftime("%Y-%m-%d %H:%M:%S")
-    with debug_lock:
-        with open("/var/log/doord.log", 'at') as log_fh:
-            log_fh.write("%s: %s\n" % (tstr, msg))
+    if log_writer is not None:
+        log_writer.write(msg)
+
+# Writes log messages from a background thread so that logging never
+# blocks the door threads.  Messages are written in batches to a single
+# file handle, which is reopened when logrotate moves the file away.
+class LogWriter(threading.Thread):
+    def __init__(self, path):
+        super(LogWriter, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.queue = Queue.Queue(LOG_QUEUE_SIZE)
+        self.fh = None
+        self.last_check = 0
+        self.dropped = 0
+        self.reported_dropped = 0
+
+    # Can be called from any thread
+    def write(self, msg):
+        try:
+            self.queue.put_nowait((time.time(), msg))
+        except Queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        try:
+            self.queue.put((None, None), True, 10)
+        except Queue.Full:
+            return
+        self.join(10)
+
+    def _open(self):
+        if self.fh is not None:
+            now = time.time()
+            if now < self.last_check + LOG_REOPEN_CHECK:
+                return
+            self.last_check = now
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.fh.fileno()).st_ino:
+                    return
+            except OSError:
+                pass
+            self.fh.close()
+        self.fh = open(self.path, 'at')
+
+    def _format(self, t, msg):
+        tstr = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        return "%s: %s\n" % (tstr, msg)
 
+    def run(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            lines = []
+            for t, msg in batch:
+                if msg is None:
+                    done = True
+                    continue
+                lines.append(self._format(t, msg))
+            dropped = self.dropped
+            if dropped != self.reported_dropped:
+                lines.append(self._format(time.time(), "%d log messages dropped"
+                    % (dropped - self.reported_dropped)))
+                self.reported_dropped = dropped
+            try:
+                self._open()
+                self.fh.writelines(lines)
+                self.fh.flush()
+            except IOError:
+                if self.fh is not None:
+                    self.fh.close()
+                self.fh = None
+        if self.fh is not None:
+            self.fh.close()
+
+# Threads are stopped by kill(), which makes the thread raise
+# KeyboardInterrupt the next time it calls check_kill().  Every blocking
+# wait (wait(), wait_fds(), delay()) is woken by kill(), so a thread
+# stops as soon as its current operation finishes.
 class KillableThread(threading.Thread):
     def __init__(self):
         super(KillableThread, self).__init__()
         self._killed = False
         self._cond = threading.Condition()
         self.notify = self._cond.notify
+        # Written to wake the thread from wait_fds()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
 
     def __enter__(self):
         self._cond.acquire()
@@ -120,8 +363,11 @@ class KillableThread(threading.Thread):
         self._cond.release()
         return False
 
+    # The wakeup comes first, as the thread may be holding its lock
+    # while in wait_fds()
     def kill(self):
         self._killed = True
+        self.wakeup()
         with self:
             self._cond.notify()
 
@@ -134,10 +380,73 @@ class KillableThread(threading.Thread):
         if self._killed:
             raise KeyboardInterrupt
 
+    # Wake the thread if it is in wait_fds()
+    def wakeup(self):
+        try:
+            os.write(self._wake_w, "x")
+        except OSError as e:
+            # A full pipe means a wakeup is already pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    # Wait until one of fds is readable, wakeup() is called or the timeout
+    # expires.  Returns the readable fds.  If locked the thread lock must
+    # be held, and is dropped while waiting.
+    def wait_fds(self, fds, timeout, locked=False):
+        self.check_kill()
+        if locked:
+            self._cond.release()
+        try:
+            ready = select.select([self._wake_r] + fds, [], [], timeout)[0]
+        except select.error as e:
+            if e[0] != errno.EINTR:
+                raise
+            ready = []
+        finally:
+            if locked:
+                self._cond.acquire()
+        if self._wake_r in ready:
+            try:
+                os.read(self._wake_r, 64)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            ready.remove(self._wake_r)
+        self.check_kill()
+        return ready
+
     def delay(self, secs):
-        for i in xrange(0, secs):
-            self.check_kill()
-            time.sleep(1)
+        end = time.time() + secs
+        while True:
+            timeout = end - time.time()
+            if timeout <= 0:
+                break
+            self.wait_fds([], timeout)
+
+# Latency histogram, exported in Prometheus form by MetricsThread
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, val):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, val)] += 1
+            self.sum += val
+
+    # Returns ([(bound, cumulative count)], total count, sum)
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cum = []
+        n = 0
+        for (b, c) in zip(self.buckets, counts):
+            n += c
+            cum.append((b, n))
+        return (cum, n + counts[-1], total)
 
 class Tag(object):
     NONE = 0
@@ -163,6 +472,203 @@ class Tag(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+# Pool of long-lived database connections.
+# We used to open a fresh connection for every query because a persistent
+# one behaved strangely: it would sit inside an open transaction (and see a
+# stale snapshot of InnoDB tables), and eventually be dropped by the server
+# with "MySQL server has gone away".  Pooled connections run in autocommit
+# mode, are pinged when checked out and are recycled after DB_MAX_AGE.
+class DBPool(object):
+    def __init__(self, user, passwd, dbg):
+        self.user = user
+        self.passwd = passwd
+        self.dbg = dbg
+        self.lock = threading.Lock()
+        self.idle = []
+        self.age = {}
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        db = MySQLdb.connect(host="localhost", user=self.user,
+                passwd=self.passwd, db="hackspace")
+        db.autocommit(True)
+        with self.lock:
+            self.connects += 1
+            self.age[db] = time.time()
+            self.dbg("DB connect (connects=%d reuses=%d reconnects=%d)"
+                    % (self.connects, self.reuses, self.reconnects))
+        return db
+
+    def _close(self, db):
+        with self.lock:
+            self.age.pop(db, None)
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+
+    # Check out a connection, creating a new one if none are available
+    def get(self):
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                db = self.idle.pop()
+                expired = self.age[db] + DB_MAX_AGE < time.time()
+            if expired:
+                self._close(db)
+                continue
+            try:
+                db.ping()
+            except MySQLdb.Error:
+                self._close(db)
+                with self.lock:
+                    self.reconnects += 1
+                continue
+            with self.lock:
+                self.reuses += 1
+            return db
+        return self._connect()
+
+    # Return a healthy connection to the pool
+    def put(self, db):
+        with self.lock:
+            if len(self.idle) < DB_POOL_SIZE:
+                self.idle.append(db)
+                return
+        self._close(db)
+
+    # Drop a connection that may be broken
+    def discard(self, db):
+        self._close(db)
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for db in idle:
+            self._close(db)
+
+# Append-only file of database writes waiting to be replayed.
+# Each record is a 4 byte little-endian length followed by a marshalled
+# (method name, args) tuple.  A truncated record at the end (from a
+# crash part way through a write) is ignored.
+class Journal(object):
+    def __init__(self, path, max_size, dbg):
+        self.path = path
+        self.max_size = max_size
+        self.dbg = dbg
+        self.lock = threading.Lock()
+        self.f = None
+        self.dirty = False
+        self.appended = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.syncs = 0
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    # True if there are records waiting to be replayed
+    def pending(self):
+        with self.lock:
+            return self.f is not None or self.size() > 0
+
+    # Returns False if the record was dropped because the journal is full
+    def append(self, rec):
+        data = marshal.dumps(rec)
+        with self.lock:
+            if self.f is None:
+                d = os.path.dirname(self.path)
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+                self.f = open(self.path, "ab")
+            if self.f.tell() + len(data) + 4 > self.max_size:
+                self.dropped += 1
+                self.dbg("Journal full, dropped %s (dropped=%d)"
+                        % (rec[0], self.dropped))
+                return False
+            self.f.write(struct.pack("<I", len(data)) + data)
+            self.f.flush()
+            self.dirty = True
+            self.appended += 1
+        return True
+
+    # Make appended records durable.  Called once per batch of appends.
+    def sync(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.f.fileno())
+                self.dirty = False
+                self.syncs += 1
+
+    # Returns a list of (end offset, record)
+    def records(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.flush()
+            recs = []
+            try:
+                f = open(self.path, "rb")
+            except IOError:
+                return recs
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    return recs
+                m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    off = 0
+                    while off + 4 <= size:
+                        n = struct.unpack_from("<I", m, off)[0]
+                        if off + 4 + n > size:
+                            break
+                        try:
+                            rec = marshal.loads(m[off + 4:off + 4 + n])
+                        except ValueError:
+                            break
+                        off += 4 + n
+                        recs.append((off, rec))
+                finally:
+                    m.close()
+            # Appends are complete under the lock, so anything left over
+            # is damage from a crash
+            if off < size:
+                self.dbg("Discarding %d bytes of damaged journal"
+                        % (size - off))
+                with open(self.path, "r+b") as f:
+                    f.truncate(off)
+            return recs
+
+    # Drop records up to offset, which must come from records().
+    # Anything appended since is kept.
+    def consume(self, offset, count):
+        with self.lock:
+            if self.f is not None:
+                self.f.flush()
+                if self.dirty:
+                    os.fsync(self.f.fileno())
+                    self.dirty = False
+                self.f.close()
+                self.f = None
+            self.replayed += count
+            if offset >= self.size():
+                os.remove(self.path)
+                return
+            tmp = self.path + ".tmp"
+            with open(self.path, "rb") as src:
+                src.seek(offset)
+                with open(tmp, "wb") as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            os.rename(tmp, self.path)
+
 # Handles both key updates and logging
 class DBThread(KillableThread):
     def __init__(self, g):
@@ -171,34 +677,126 @@ class DBThread(KillableThread):
         self.db_user = self.g.config.get("db", "user")
         self.db_passwd = self.g.config.get("db", "password")
         self.tags = []
+        self.tag_fingerprint = None
         self.door_state = {}
         for k in port_door_map.values():
             self.door_state[k] = False
         self.space_open_state = None
         self.last_tag_out = None
-
-    def dbg(self, msg):
-        dbg("dbt: %s" % (msg))
+        self.pool = DBPool(self.db_user, self.db_passwd, self.dbg)
+        self.journal = Journal(DB_JOURNAL_FILE, DB_JOURNAL_MAX, self.dbg)
+        # Per @dbwrapper method: latency Histogram and error count
+        self.db_latency = {}
+        self.db_errors = {}
+        # In-memory copies used by query_override.  These are replaced
+        # (never modified) by the poll loop, so may be read without the lock.
+        self.member_tags = None
+        self.member_tags_time = 0
+        self.open_days = None
+        self.open_days_time = 0
+        # Unexpired OTP codes: {length: {code: expiry time}}
+        self.otp_keys = None
+        self.otp_keys_time = 0
+        self.stats_lock = threading.Lock()
+        self.override_count = 0
+        self.override_cached = 0
+        self.override_latency_total = 0.0
+        self.override_latency_max = 0.0
+        # Rows waiting for flush_batch, as (table, row)
+        self.batch_lock = threading.Lock()
+        self.batch = []
+        self.batch_timer = None
+        self.batch_flushes = 0
+        self.batch_rows = 0
+        # Statements issued and rows affected by update_arp_entries
+        self.presence_statements = 0
+        self.presence_rows = 0
+
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("dbt: %s" % (msg), level)
 
     def dbwrapper(fn):
         def _dbwrapper(self, *args, **kwargs):
-            with self:
-                db = None
-                cursor = None
-                try:
-                    # We used to use a persistent database connection.  However this has strange 
-                    db = MySQLdb.connect(host="localhost", user=self.db_user,
-                            passwd=self.db_passwd, db="hackspace")
+            t = time.time()
+            # Connections are checked out before taking the lock so that
+            # a slow (re)connect does not hold up other callers.  get()
+            # pings a pooled connection and replaces it if it has gone
+            # away.  Failures after that are not retried, as earlier
+            # statements in fn may already have been applied.
+            try:
+                db = self.pool.get()
+            except MySQLdb.Error:
+                self.db_errors[fn.__name__] = \
+                        self.db_errors.get(fn.__name__, 0) + 1
+                raise
+            try:
+                with self:
                     cursor = db.cursor()
-                    rc = fn(self, cursor, *args, **kwargs)
-                finally:
-                    if cursor is not None:
+                    try:
+                        rc = fn(self, cursor, *args, **kwargs)
+                    finally:
                         cursor.close()
-                    if db is not None:
-                        db.close()
-                return rc
+            except MySQLdb.OperationalError:
+                self.pool.discard(db)
+                self.db_errors[fn.__name__] = \
+                        self.db_errors.get(fn.__name__, 0) + 1
+                raise
+            except:
+                self.pool.put(db)
+                raise
+            self.pool.put(db)
+            h = self.db_latency.get(fn.__name__)
+            if h is None:
+                h = self.db_latency.setdefault(fn.__name__, Histogram())
+            h.observe(time.time() - t)
+            return rc
+        _dbwrapper.__name__ = fn.__name__
         return _dbwrapper
 
+    # For writes that must not be lost.  If the database is unavailable
+    # (or earlier writes are still waiting) the call is appended to the
+    # journal, to be replayed in order by replay_journal() from the poll
+    # loop.  Journalled methods only write rows: anything time dependent
+    # is passed in by the caller, and side effects (IRC, the servo, space
+    # state) are left to the caller so that they are not repeated late.
+    def journalled(fn):
+        def _journalled(self, *args):
+            if not self.journal.pending():
+                try:
+                    return fn(self, *args)
+                except MySQLdb.OperationalError as e:
+                    self.dbg("%s failed: %s" % (fn.__name__, e))
+            if self.journal.append((fn.__name__, args)):
+                schedule_once(self.journal.sync)
+        _journalled.raw = fn
+        _journalled.__name__ = fn.__name__
+        return _journalled
+
+    # Replay journalled writes in order, stopping at the first failure.
+    # Only called from the main thread.
+    def replay_journal(self):
+        done = 0
+        count = 0
+        t = time.time()
+        for (end, (name, args)) in self.journal.records():
+            try:
+                getattr(self, name).raw(self, *args)
+            except MySQLdb.OperationalError as e:
+                self.dbg("Journal replay stopped: %s" % e)
+                break
+            except Exception:
+                # Not going to succeed next time either, so skip it
+                self.dbg("Dropping journal record %s%s" % (name, args))
+                traceback.print_exc()
+            done = end
+            count += 1
+        if done > 0:
+            self.journal.consume(done, count)
+            self.dbg("Replayed %d journalled writes in %.1fms"
+                    % (count, (time.time() - t) * 1000))
+            # Presence may have changed, so recalculate from the current
+            # state of the database
+            self.update_space_state()
 
     def _keylist(self, fn):
         k = []
@@ -233,38 +831,58 @@ class DBThread(KillableThread):
             " WHERE ref='webcam';")
         row = cur.fetchone()
         if row is not None:
-            schedule(self.g.aux.set_servo, int(row[0]))
-
-    # Read and update tag list from database
+            schedule_once(self.g.aux.set_servo, int(row[0]))
+
+    # Read and update tag list from database.
+    # The row counts, sizes and modification times from SHOW TABLE STATUS
+    # are compared first so the full join is only fetched when something
+    # has actually changed.  This reads only table metadata; CHECKSUM TABLE
+    # would scan both tables on every poll.  Update_time has one second
+    # resolution (and may be NULL on some engines), so a recent or missing
+    # time forces a full read on the next poll as well.
     @dbwrapper
     def poll_tags(self, cur):
-        changed = False
         try:
+            cur.execute("SHOW TABLE STATUS WHERE Name IN ('people', 'rfid_tags');")
+            cols = [d[0] for d in cur.description]
+            fingerprint = [tuple(row[cols.index(c)] for c in TAG_STATUS_COLUMNS)
+                    for row in cur.fetchall()]
+            recent = datetime.datetime.now() - datetime.timedelta(seconds=2)
+            for row in fingerprint:
+                update_time = row[TAG_STATUS_COLUMNS.index("Update_time")]
+                if update_time is None or update_time >= recent:
+                    fingerprint = None
+                    break
+            if fingerprint is not None and fingerprint == self.tag_fingerprint:
+                self.member_tags_time = time.time()
+                return
+            t = time.time()
             cur.execute( \
                 "SELECT rfid_tags.card_id, rfid_tags.pin, people.access" \
                 " FROM people INNER JOIN rfid_tags" \
                 " ON (people.id = rfid_tags.user_id)" \
                 " WHERE (people.access != 'NO')" \
                 " ORDER BY rfid_tags.card_id;")
-            tag_num = 0
-            while True:
-                row = cur.fetchone()
-                if row is None:
-                    break;
-                t = Tag(row[0], row[1], row[2])
-                if not changed:
-                    if (tag_num == len(self.tags)) or (self.tags[tag_num] != t):
-                        self.dbg("Tags changed");
-                        changed = True
-                        del self.tags[tag_num:]
-                    else:
-                        tag_num += 1
-                if changed:
-                    self.tags.append(t)
+            tags = [Tag(row[0], row[1], row[2]) for row in cur.fetchall()]
+            cur.execute( \
+                "SELECT rfid_tags.card_id" \
+                " FROM people INNER JOIN rfid_tags" \
+                " ON (people.id = rfid_tags.user_id)" \
+                " WHERE (people.member = 'YES');")
+            member_tags = set(row[0].upper() for row in cur.fetchall())
+            self.dbg("Read %d tags in %.1fms"
+                    % (len(tags), (time.time() - t) * 1000))
         except:
             self.tags = []
+            self.tag_fingerprint = None
+            self.member_tags = None
             raise
-        if changed:
+        self.tag_fingerprint = fingerprint
+        self.member_tags = member_tags
+        self.member_tags_time = time.time()
+        if tags != self.tags:
+            self.dbg("Tags changed");
+            self.tags = tags
             self.sync_keys()
 
     def _recent_tag_out(self):
@@ -316,14 +934,14 @@ class DBThread(KillableThread):
                 new_state = False
             if old_state and not new_state:
                 self.space_open_state = False
-                self.g.irc.send("The space is closed")
+                self.g.irc.send("The space is closed", "space")
                 self.g.hifi.cmd("stop")
         else:
             # Somebody here
             if not old_state:
                 # Open the space
                 self.space_open_state = True
-                self.g.irc.send("The space is open! %s is here!" % row[0])
+                self.g.irc.send("The space is open! %s is here!" % row[0], "space")
         if self.space_open_state != old_state:
             if self.space_open_state:
                 state_val = 0
@@ -334,46 +952,82 @@ class DBThread(KillableThread):
                 " SET value=%d" \
                 " WHERE ref = 'space-state';" \
                 % state_val)
-            schedule(self.g.aux.set_open, self.space_open_state)
+            schedule_once(self.g.aux.set_open, self.space_open_state)
 
     # Can be safely called from other threads
     def update_space_state(self):
-        schedule(self._really_update)
-
+        schedule_once(self._really_update)
+
+    # Queue a row for the next batched insert
+    def _add_row(self, table, row):
+        with self.batch_lock:
+            self.batch.append((table, row))
+            if len(self.batch) >= DB_BATCH_SIZE:
+                schedule_once(self.flush_batch)
+            elif self.batch_timer is None:
+                self.batch_timer = self.g.schedule_delay(self.flush_batch,
+                        DB_BATCH_DELAY)
+
+    @journalled
     @dbwrapper
-    def _really_log(self, cur, t, msg):
-        tstr = time.strftime("%Y-%m-%d %H:%M:%S", t)
-        self.dbg("LOG: %s %s" % (tstr, msg));
-        cur.execute( \
-                "INSERT INTO security (time, message)" \
-                " VALUES ('%s', '%s');" % (tstr, msg))
+    def _insert_rows(self, cur, table, rows):
+        cur.executemany(batch_inserts[table], rows)
+
+    # Write out queued rows as one multi-row insert per table.
+    # Only called from the main thread.
+    def flush_batch(self):
+        with self.batch_lock:
+            rows = self.batch
+            self.batch = []
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+        if len(rows) == 0:
+            return
+        for table in ("security", "environmental"):
+            vals = [row for (tb, row) in rows if tb == table]
+            if len(vals) > 0:
+                self._insert_rows(table, vals)
+                self.batch_rows += len(vals)
+        self.batch_flushes += 1
 
     # Can be safely called from other threads
     def log(self, t, msg):
-        schedule(self._really_log, t, msg)
+        tstr = time.strftime("%Y-%m-%d %H:%M:%S", t)
+        self.dbg("LOG: %s %s" % (tstr, msg));
+        self._add_row("security", (tstr, msg))
 
-    # Called from other threads
+    # t is the time of the scan
+    @journalled
     @dbwrapper
-    def do_tag_in(self, cur, tag):
-        self._add_presence_entry(cur, tag, 'r')
+    def _write_tag_in(self, cur, t, tag):
+        self._add_presence_entry(cur, tag, 'r', t)
         cur.execute( \
             "UPDATE (systems INNER JOIN rfid_tags" \
             "  ON (systems.owner = rfid_tags.user_id))" \
             " SET systems.hidden = 0" \
             " WHERE rfid_tags.card_id = '%s' AND systems.hidden = 2;" \
             % (tag))
-        self.update_space_state();
 
     # Called from other threads
+    def do_tag_in(self, tag):
+        self._write_tag_in(int(time.time()), tag)
+        self.update_space_state();
+
+    @journalled
     @dbwrapper
-    def do_tag_out(self, cur, tag):
+    def _write_tag_out(self, cur, tag):
         cur.execute( \
             "UPDATE (systems INNER JOIN rfid_tags" \
             "  ON (systems.owner = rfid_tags.user_id))" \
             " SET systems.hidden = 2" \
             " WHERE rfid_tags.card_id = '%s' AND systems.hidden = 0;" \
             % (tag))
+
+    # Called from other threads
+    def do_tag_out(self, tag):
         self.last_tag_out = time.time()
+        self._write_tag_out(tag)
         self.update_space_state();
 
     # Called from other threads
@@ -391,41 +1045,58 @@ class DBThread(KillableThread):
             " WHERE systems.hidden = 0;")
         self.update_space_state()
 
-    def _add_presence_entry(self, cur, mac, source):
+    # t is the time the device was seen
+    def _add_presence_entry(self, cur, mac, source, t):
         if source == 'r':
             lifetime = RFID_SCAN_LIFETIME
         else:
             lifetime = ARP_LIFETIME
         cur.execute( \
             "REPLACE INTO presence_deadline" \
-            " SELECT id, now() + interval %d second" \
+            " SELECT id, from_unixtime(%d) + interval %d second" \
             " FROM systems" \
             " WHERE source = '%s' AND mac = '%s'" \
-            % (lifetime, source, mac))
+            % (t, lifetime, source, mac))
 
 
     # Called from other threads
+    # Extends the presence deadline of every registered network device in
+    # macs that is close to expiring, and records any of the (mac, ip)
+    # pairs in unseen that are not registered as bogons.  One statement
+    # each, whatever the number of devices.
     @dbwrapper
-    def update_arp_entries(self, cur, macs):
-        for m in macs:
-            self._add_presence_entry(cur, m, 'e')
+    def update_arp_entries(self, cur, macs, unseen):
+        if len(macs) > 0:
+            cur.execute( \
+                "INSERT INTO presence_deadline (system, expires)" \
+                " SELECT s.id, now() + interval %d second" \
+                " FROM systems AS s" \
+                " WHERE s.source = 'e'" \
+                "  AND s.mac IN (%s)" \
+                "  AND s.id NOT IN" \
+                "  (SELECT pd.system FROM presence_deadline AS pd" \
+                "   WHERE pd.expires >= now() + interval %d second)" \
+                " ON DUPLICATE KEY UPDATE expires = VALUES(expires);" \
+                % (ARP_LIFETIME, ", ".join("'%s'" % m for m in macs),
+                    ARP_EXTEND_BELOW))
+            self.presence_statements += 1
+            self.presence_rows += cur.rowcount
+        if len(unseen) > 0:
+            self.dbg("Checking bogons %s" % ", ".join(
+                "%s (%s)" % (m, ip) for (m, ip) in unseen))
+            cur.execute( \
+                "REPLACE INTO bogons (address, info)" \
+                " SELECT * FROM (%s) AS tmp" \
+                " WHERE NOT EXISTS" \
+                "  (SELECT systems.mac" \
+                "   FROM systems" \
+                "   WHERE systems.mac = tmp.mac" \
+                "    AND systems.source = 'e');" \
+                % " UNION ALL ".join("SELECT '%s' AS mac, '%s' AS ip" % e
+                    for e in unseen))
+            self.presence_statements += 1
         self.update_space_state();
 
-    # Called from other threads
-    @dbwrapper
-    def check_bogon(self, cur, mac, ip):
-        self.dbg("Checking bogon %s (%s)" % (mac, ip))
-        cur.execute( \
-            "REPLACE INTO bogons (address, info)" \
-            " SELECT * FROM" \
-            "  (SELECT '%s' as mac, '%s') AS tmp" \
-            " WHERE NOT EXISTS" \
-            "  (SELECT systems.mac" \
-            "   FROM systems" \
-            "   WHERE systems.mac = tmp.mac" \
-            "    AND systems.source = 'e');" \
-            % (mac, ip))
-
     @dbwrapper
     def poll_space_open(self, cur):
         cur.execute( \
@@ -436,11 +1107,114 @@ class DBThread(KillableThread):
         last_state = self.space_open_state
         self.space_open_state = (row is not None)
         if last_state != self.space_open_state:
-            schedule(self.g.aux.set_open, self.space_open_state)
+            schedule_once(self.g.aux.set_open, self.space_open_state)
+
+    # Read open day windows that have not finished yet
+    @dbwrapper
+    def poll_open_days(self, cur):
+        cur.execute( \
+            "SELECT start, end" \
+            " FROM open_days" \
+            " WHERE (end > now());")
+        self.open_days = list(cur.fetchall())
+        self.open_days_time = time.time()
+
+    # Read unexpired OTP codes, indexed by length
+    @dbwrapper
+    def poll_otp_keys(self, cur):
+        t = time.time()
+        cur.execute( \
+            "SELECT val, TIMESTAMPDIFF(SECOND, now(), expires)" \
+            " FROM otp_keys" \
+            " WHERE (expires > now());")
+        otp_keys = {}
+        for (val, ttl) in cur.fetchall():
+            if len(val) < 6:
+                continue
+            otp_keys.setdefault(len(val), {})[val] = t + ttl
+        self.otp_keys = otp_keys
+        self.otp_keys_time = t
+
+    # Can be called from other threads
+    @dbwrapper
+    def extend_otp(self, cur, val):
+        cur.execute( \
+            "UPDATE otp_keys" \
+            " SET expires = now() + interval %d second" \
+            " WHERE (val = '%s')" \
+            % (OTP_EXTEND, val));
+        schedule_once(self.poll_otp_keys)
+
+    # Match the tail of the digits entered against the cached OTP codes.
+    # Returns None if the cache is missing or stale.
+    def _cached_otp(self, match):
+        otp_keys = self.otp_keys
+        t = time.time()
+        if otp_keys is None or self.otp_keys_time + AUTH_MAX_AGE < t:
+            return None
+        for (n, vals) in otp_keys.items():
+            val = match[-n:]
+            expires = vals.get(val)
+            if expires is not None and expires > t:
+                self.dbg("Matched OTP key %s" % val)
+                schedule(self.extend_otp, val)
+                return True
+        # A code may have been added since the last refresh
+        if self.otp_keys_time + OTP_MISS_REFRESH < t:
+            schedule_once(self.poll_otp_keys)
+        return False
+
+    # Answer query_override from the in-memory copies.
+    # Returns None if they are missing or stale.
+    def _cached_override(self, tag, match):
+        t = time.time()
+        if tag[0] == '!' and tag != '!#':
+            return self._cached_otp(match)
+        if tag == '!#':
+            open_days = self.open_days
+            if open_days is None or self.open_days_time + AUTH_MAX_AGE < t:
+                return None
+            now = datetime.datetime.now()
+            if (now.weekday() == 1) and (now.hour >= 17):
+                return bool(self.space_open_state)
+            for (start, end) in open_days:
+                if start <= now and end > now:
+                    return bool(self.space_open_state)
+            return False
+        member_tags = self.member_tags
+        if member_tags is None or self.member_tags_time + AUTH_MAX_AGE < t:
+            return None
+        if tag.upper() not in member_tags:
+            return False
+        return bool(self.space_open_state)
 
     # Called from other threads
+    # Answered from memory when possible.
+    def query_override(self, tag, match=""):
+        t = time.time()
+        r = self._cached_override(tag, match)
+        cached = r is not None
+        if not cached:
+            r = self._db_query_override(tag, match)
+        lat = time.time() - t
+        # Not the thread lock, which is held during polling
+        with self.stats_lock:
+            self.override_count += 1
+            if cached:
+                self.override_cached += 1
+            self.override_latency_total += lat
+            self.override_latency_max = max(self.override_latency_max, lat)
+        if log_level >= LOG_TRACE:
+            if cached:
+                how = "cached"
+            else:
+                how = "database"
+            self.dbg("Override %s: %s in %.2fms (%s)"
+                    % (tag, r, lat * 1000, how), LOG_TRACE)
+        return r
+
     @dbwrapper
-    def query_override(self, cur, tag, match=""):
+    def _db_query_override(self, cur, tag, match=""):
         def is_open_evening():
             now = datetime.datetime.now()
             if (now.weekday() == 1) and (now.hour >= 17):
@@ -469,14 +1243,14 @@ class DBThread(KillableThread):
                 val = row[0]
                 if len(val) < 6:
                     continue
-                self.dbg("Matching '%s'/'%s'" % (val, match))
+                self.dbg("Matching '%s'/'%s'" % (val, match), LOG_TRACE)
                 if val == match[-len(val):]:
                     self.dbg("Matched OTP key %s" % val)
                     cur.execute( \
                         "UPDATE otp_keys" \
-                        " SET expires = now() + interval 10 minute" \
+                        " SET expires = now() + interval %d second" \
                         " WHERE (val = '%s')" \
-                        % val);
+                        % (OTP_EXTEND, val));
                     return True
             return False
         else:
@@ -493,33 +1267,36 @@ class DBThread(KillableThread):
         return False
 
     # Can be called from other threads
-    @dbwrapper
-    def record_temp(self, cur, temp):
+    def record_temp(self, temp):
         self.dbg("Logging temperature %d" % temp)
+        tstr = time.strftime("%Y-%m-%d %H:%M:%S")
+        self._add_row("environmental", (tstr, temp))
+
+    @journalled
+    @dbwrapper
+    def _write_door_state(self, cur, door_name, state_name):
         cur.execute( \
-            "INSERT INTO environmental(temperature)" \
-            " VALUES (%d)" \
-            % (temp))
+            "REPLACE INTO prefs"\
+            " VALUES ('%s','%s')" \
+            % (door_name, state_name))
 
     # Can be called from other threads
-    @dbwrapper
-    def set_door_state(self, cur, port, state):
+    def set_door_state(self, port, state):
         door_name = port_door_map[port]
-        if self.door_state[door_name] != state:
+        with self:
+            changed = self.door_state[door_name] != state
+            self.door_state[door_name] = state
+        if changed:
             if state:
                 state_name = "open"
             else:
                 state_name = "closed"
-            cur.execute( \
-                "REPLACE INTO prefs"\
-                " VALUES ('%s','%s')" \
-                % (door_name, state_name))
-            self.door_state[door_name] = state
+            self._write_door_state(door_name, state_name)
             if door_name == "internaldoor":
                 if state:
                     schedule(self.g.aux.servo_override, 180)
                 if not self.space_open_state:
-                    self.g.irc.send("Internal door %s" % state_name)
+                    self.g.irc.send("Internal door %s" % state_name, door_name)
         self.update_space_state();
 
     def sync_keys(self):
@@ -532,52 +1309,49 @@ class DBThread(KillableThread):
             try:
                 self.poll_space_open()
                 self.poll_tags()
+                self.poll_open_days()
+                self.poll_otp_keys()
+                if self.journal.pending():
+                    schedule_once(self.replay_journal)
                 self.poll_webcam()
                 self.sync_dummy_tags()
                 with self:
                     self.wait(DB_POLL_PERIOD)
             except KeyboardInterrupt:
                 self.dbg("Stopped");
+                self.pool.close_all()
                 break;
             except BaseException as e:
                 self.dbg(str(e))
             except:
                 self.dbg("Wonky exception")
 
+B64_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+# Indexed by character code, -1 for characters not in B64_CHARS
+B64_DECODE = [-1] * 256
+for (i, c) in enumerate(B64_CHARS):
+    B64_DECODE[ord(c)] = i
+HEX_DECODE = [-1] * 256
+for (i, c) in enumerate("0123456789ABCDEF"):
+    HEX_DECODE[ord(c)] = i
+
 def encode64(val):
-    if val < 26:
-        return chr(val + ord("A"))
-    val -= 26;
-    if val < 26:
-        return chr(val + ord("a"))
-    val -= 26;
-    if val < 10:
-        return chr(val + ord("0"))
-    val -= 10;
-    if val == 0:
-        return '+';
-    if val == 1:
-        return '/';
+    if val < 64:
+        return B64_CHARS[val]
     return '*';
 
 def decode64(c):
-    if c >= 'A' and c <= 'Z':
-        return ord(c) - ord('A')
-    if c >= 'a' and c <= 'z':
-        return ord(c) + 26 - ord('a')
-    if c >= '0' and c <= '9':
-        return ord(c) + 52 - ord('0')
-    if c == '+':
-        return 62
-    if c == '/':
-        return 63
-    raise Exception("Bad base64 character: '%s'" % c)
-
-def encoded_time():
-    t = int(time.time())
+    val = B64_DECODE[ord(c)]
+    if val < 0:
+        raise Exception("Bad base64 character: '%s'" % c)
+    return val
+
+def encoded_time(t=None):
+    if t is None:
+        t = int(time.time())
     s = ""
     for i in xrange(0, 6):
-        s += encode64(t & 0x3f)
+        s += B64_CHARS[t & 0x3f]
         t >>= 6;
     return s
 
@@ -590,10 +1364,126 @@ def decode_time(s):
 def crc_str(s):
     return "%04X" % crc16.crc16xmodem(s)
 
+# Door lock frame encodings.  Messages are the type and address characters
+# followed by the data, as described in DoorLock.ino.  next_frame() works
+# on a bytearray receive buffer in place, and returns (pos, msg, crc_ok)
+# for the first frame at or after pos, or None if there is no complete
+# frame yet.  msg is None for frames that carry no message (comments,
+# noise between frames).
+
+# Newline terminated, with a hex CRC
+class AsciiCodec(object):
+    name = "ascii"
+
+    def encode(self, msg):
+        return msg + crc_str(msg) + "\n"
+
+    def next_frame(self, buf, pos):
+        i = buf.find("\n", pos)
+        if i < 0:
+            return None
+        if i - pos < 5 or buf[pos] == 0x23:
+            return (i + 1, None, True)
+        crc = (HEX_DECODE[buf[i - 4]] << 12) | (HEX_DECODE[buf[i - 3]] << 8) \
+                | (HEX_DECODE[buf[i - 2]] << 4) | HEX_DECODE[buf[i - 1]]
+        n = i - 4 - pos
+        if crc != crc16.crc16xmodem(buffer(buf, pos, n)):
+            return (i + 1, None, False)
+        return (i + 1, str(buf[pos:pos + n]), True)
+
+    def encode_time(self, t):
+        return encoded_time(t)
+
+    def encode_hash(self, crc):
+        return "%04X" % crc
+
+    # Log records from a MSG_LOG_VALUE reply, comma separated for bulk
+    def split_log(self, data, bulk):
+        return data.split(",")
+
+    # Returns (time, action, tag), or None if the record is too short
+    def decode_log(self, rec):
+        if len(rec) < 7:
+            return None
+        return (decode_time(rec[0:6]), rec[6], rec[7:])
+
+# FRAME_SYNC and a length byte, with a binary CRC and raw timestamps
+class BinaryCodec(object):
+    name = "binary"
+    SYNC = 0xFE
+
+    def encode(self, msg):
+        return struct.pack(">BB", self.SYNC, len(msg)) + msg \
+                + struct.pack(">H", crc16.crc16xmodem(msg))
+
+    def next_frame(self, buf, pos):
+        i = buf.find(chr(self.SYNC), pos)
+        if i < 0:
+            if pos == len(buf):
+                return None
+            return (len(buf), None, True)
+        if i + 2 > len(buf):
+            return None
+        n = buf[i + 1]
+        if n < 2 or n > DOOR_MAX_FRAME - 2:
+            return (i + 1, None, False)
+        end = i + 2 + n + 2
+        if end > len(buf):
+            return None
+        crc = (buf[end - 2] << 8) | buf[end - 1]
+        if crc != crc16.crc16xmodem(buffer(buf, i + 2, n)):
+            # Look for the next sync byte inside this frame
+            return (i + 1, None, False)
+        return (end, str(buf[i + 2:i + 2 + n]), True)
+
+    def encode_time(self, t):
+        return struct.pack("<I", t)
+
+    def encode_hash(self, crc):
+        return struct.pack(">H", crc)
+
+    # Bulk replies have a length byte before each record
+    def split_log(self, data, bulk):
+        if not bulk:
+            return [data]
+        recs = []
+        i = 0
+        while i < len(data):
+            n = ord(data[i])
+            if i + 1 + n > len(data):
+                raise Exception("Truncated log record")
+            recs.append(data[i + 1:i + 1 + n])
+            i += 1 + n
+        return recs
+
+    def decode_log(self, rec):
+        if len(rec) < 5:
+            return None
+        return (struct.unpack_from("<I", rec)[0], rec[4], rec[5:])
+
+ASCII_CODEC = AsciiCodec()
+BINARY_CODEC = BinaryCodec()
+
+# Pack keys into as few comma separated frames as possible
+def key_frames(cmd, keys):
+    limit = DOOR_MAX_FRAME - 4
+    frame = cmd
+    for key in keys:
+        if len(frame) == len(cmd):
+            frame += key
+        elif len(frame) + 1 + len(key) <= limit:
+            frame += ',' + key
+        else:
+            yield frame
+            frame = cmd + key
+    if len(frame) > len(cmd):
+        yield frame
+
 # Communicate with auxiliary arduino (sign, webcam)
 # Extra care must be taken to avoid deadlock between this DBThread
 # In particular AuxMonitor.work() is called with the lock held and
-# calls synchronous locking DBThread functions.
+# calls synchronous locking DBThread functions.  The lock is only dropped
+# while waiting for Marvin to answer.
 class AuxMonitor(KillableThread):
     def __init__(self, g, port):
         super(AuxMonitor, self).__init__()
@@ -603,22 +1493,67 @@ class AuxMonitor(KillableThread):
         self.last_servo = None
         self.servo_override_pos = None
         self.servo_override_time = None
+        self.servo_override_timer = None
         self.temp_due = True
         self.bell_duration = None
         self.sign_on = False
         self.g = g
+        self.cmd_rtt = Histogram()
+        self.commands = 0
+        self.batches = 0
+        self.baud = SERIAL_BAUD
+        self.baud_failed = 0
+        self.rx_buf = ""
+        self.version = None
+        self.last_response = 0
+
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("%s: %s" % (self.port_name, msg), level)
+
+    # Read one response line.  The lock is dropped while waiting.
+    def read_line(self, cmd):
+        fd = self.ser.fileno()
+        end = time.time() + SERIAL_POLL_PERIOD
+        while True:
+            i = self.rx_buf.find("\n")
+            if i >= 0:
+                break
+            timeout = end - time.time()
+            if timeout <= 0 or fd not in self.wait_fds([fd], timeout, True):
+                raise Exception("No response from command '%s'" % cmd)
+            data = self.ser.read(max(self.ser.inWaiting(), 1))
+            if data == "":
+                raise Exception("No response from command '%s'" % cmd)
+            self.rx_buf += data
+        r = self.rx_buf[:i].rstrip()
+        self.rx_buf = self.rx_buf[i + 1:]
+        self.dbg("Response %s" % r, LOG_TRACE);
+        self.last_response = time.time()
+        return r
 
-    def dbg(self, msg):
-        dbg("%s: %s" % (self.port_name, msg))
+    # Send several commands in one write, then match the responses in
+    # order.  Marvin works through its 64 byte receive buffer a command
+    # at a time, so a handful of short commands is safe.
+    # cmds is a list of (command, handler), and handler(cmd, response) is
+    # called for each response.
+    def send_cmds(self, cmds):
+        self.dbg("Sending %s" % " ".join(c for (c, fn) in cmds), LOG_TRACE);
+        t = time.time()
+        self.ser.write("".join(c + "\n" for (c, fn) in cmds))
+        for (cmd, fn) in cmds:
+            fn(cmd, self.read_line(cmd))
+        self.cmd_rtt.observe(time.time() - t)
+        self.commands += len(cmds)
+        self.batches += 1
 
     def do_cmd(self, cmd):
-        self.dbg("Sending %s" % cmd);
+        self.dbg("Sending %s" % cmd, LOG_TRACE);
+        t = time.time()
         self.ser.write(cmd + '\n')
-        r = self.ser.readline()
-        if (r is None):
-            raise Exception("No response from command '%s'", cmd)
-        r = r.rstrip()
-        self.dbg("Response %s" % r);
+        r = self.read_line(cmd)
+        self.cmd_rtt.observe(time.time() - t)
+        self.commands += 1
+        self.batches += 1
         return r
 
     def do_cmd_expect(self, cmd, response, error):
@@ -626,7 +1561,28 @@ class AuxMonitor(KillableThread):
         if r != response:
             raise Exception(error + ("'%s/%s'" %(r, response)))
 
-    def sync_sign(self):
+    def expect_ok(self, cmd, r):
+        if r != "OK":
+            raise Exception("Bad response to %s: '%s'" % (cmd, r))
+
+    def got_version(self, cmd, r):
+        if r[:10] not in MARVIN_VERSIONS:
+            raise Exception("Marvin went AWOL")
+        self.version = r[:10]
+        if r[10:] == "+":
+            self.resync()
+
+    def got_servo(self, cmd, r):
+        if r[:6] != "ANGLE=":
+            raise Exception("Bad servo response: %s" % r)
+        self.last_servo = int(r[6:])
+
+    def got_temp(self, cmd, r):
+        if r[:5] != "TEMP=":
+            raise Exception("Bad temperature response")
+        schedule(self.g.dbt.record_temp, int(r[5:]))
+
+    def sync_sign(self, cmds):
         new_sign = self.sign_on
         if (self.last_sign is None) or (self.last_sign != new_sign):
             self.last_sign = new_sign
@@ -634,14 +1590,11 @@ class AuxMonitor(KillableThread):
                 cmd = "S1"
             else:
                 cmd = "S0"
-            self.do_cmd_expect(cmd, "OK", "Failed to set sign")
-
-    def sync_servo(self):
-        if self.last_servo == None:
-            r = self.do_cmd("W")
-            if r[:6] != "ANGLE=":
-                raise Exception("Bad servo response: %s" % r)
-            self.last_servo = int(r[6:])
+            cmds.append((cmd, self.expect_ok))
+
+    # The current position is only asked for if there is nothing to move
+    # the servo to
+    def sync_servo(self, cmds):
         if self.servo_override_time <= time.time():
             self.servo_override_pos = None
         if self.servo_override_pos is not None:
@@ -650,8 +1603,10 @@ class AuxMonitor(KillableThread):
             newpos = self.servo_pos
         else:
             newpos = self.last_servo
-        if self.last_servo != newpos:
-            self.do_cmd_expect("W%d" % newpos, "OK", "Failed to move servo")
+        if newpos is None:
+            cmds.append(("W", self.got_servo))
+        elif self.last_servo != newpos:
+            cmds.append(("W%d" % newpos, self.expect_ok))
             self.last_servo = newpos
 
     def temp_trigger(self):
@@ -660,39 +1615,60 @@ class AuxMonitor(KillableThread):
             self.g.schedule_delay(self.temp_trigger, 60)
             self._update()
 
-    def sync_temp(self):
+    def sync_temp(self, cmds):
         if self.temp_due:
             self.temp_due = False
-            r = self.do_cmd("T")
-            if r[:5] != "TEMP=":
-                raise Exception("Bad temperature response")
-            schedule(self.g.dbt.record_temp, int(r[5:]))
+            cmds.append(("T", self.got_temp))
 
-    def sync_bell(self):
+    def sync_bell(self, cmds):
         if self.bell_duration is not None:
-            self.do_cmd_expect("B%d" % self.bell_duration, "OK", "Failed to ring the bell")
+            cmds.append(("B%d" % self.bell_duration, self.expect_ok))
             self.bell_duration = None
 
+    # Marvin answers at the old rate, then goes back to SERIAL_BAUD
+    # unless it hears a '?' at the new one within SERIAL_BAUD_CONFIRM
+    def set_baud(self, baud):
+        self.dbg("Switching to %d baud" % baud)
+        self.do_cmd_expect("R%d" % baud, "OK", "Failed to set baud rate")
+        self.ser.baudrate = baud
+        self.baud = baud
+        self.rx_buf = ""
+        r = self.do_cmd("?")
+        if r[:10] not in MARVIN_VERSIONS:
+            raise Exception("No response at %d baud" % baud)
+
     def resync(self):
         self.dbg("Full resync")
         self.need_sync = True
         self.last_sign = None
         self.last_servo = None
 
+    # Everything that has changed goes out in one batch, bell first.
+    # The version query is skipped while Marvin has answered recently.
     def work(self):
         self.resync()
+        self.rx_buf = ""
+        self.version = None
+        self.last_response = 0
         while True:
             self.check_kill()
-            r = self.do_cmd("?")
-            if r[:10] !=  "Marvin 1.5":
-                raise Exception("Marvin went AWOL")
-            if r[10:] == "+":
-                self.resync()
-            self.sync_sign()
-            self.sync_servo()
-            self.sync_temp()
-            self.sync_bell()
+            if self.version is None:
+                self.send_cmds([("?", self.got_version)])
+            if self.version == MARVIN_BAUD_VERSION:
+                baud = want_baud(self.g.config, self.port_name,
+                        self.baud_failed)
+                if baud != self.baud:
+                    self.set_baud(baud)
             self.need_sync = False
+            cmds = []
+            self.sync_bell(cmds)
+            if self.last_response + MARVIN_QUERY_INTERVAL < time.time():
+                cmds.append(("?", self.got_version))
+            self.sync_sign(cmds)
+            self.sync_servo(cmds)
+            self.sync_temp(cmds)
+            if len(cmds) > 0:
+                self.send_cmds(cmds)
             while not self.need_sync:
                 self.dbg("Waiting")
                 self.wait()
@@ -703,6 +1679,7 @@ class AuxMonitor(KillableThread):
             try:
                 self.dbg("Opening serial port")
                 self.ser = OpenSerial("/dev/" + self.port_name)
+                self.baud = SERIAL_BAUD
                 # Opening the port resets the arduino,
                 # which takes a few seconds to come back to life
                 self.delay(5);
@@ -711,7 +1688,7 @@ class AuxMonitor(KillableThread):
                 while self.ser.inWaiting():
                     while self.ser.inWaiting():
                         self.ser.read(1)
-                    time.sleep(1)
+                    self.delay(1)
                 with self:
                     self.work()
             except KeyboardInterrupt:
@@ -720,6 +1697,9 @@ class AuxMonitor(KillableThread):
                 break
             except BaseException as e:
                 self.dbg(str(e))
+                if self.baud != SERIAL_BAUD:
+                    self.dbg("Falling back to %d baud" % SERIAL_BAUD)
+                    self.baud_failed = time.time()
             except:
                 self.dbg("Wonky exception")
                 raise
@@ -764,7 +1744,10 @@ class AuxMonitor(KillableThread):
             if angle is not None:
                 self.servo_override_pos = angle
                 self.servo_override_time = time.time() + 10
-                self.g.schedule_delay(self.servo_override, 10, None)
+                if self.servo_override_timer is not None:
+                    self.servo_override_timer.cancel()
+                self.servo_override_timer = \
+                        self.g.schedule_delay(self.servo_override, 10, None)
             self._update()
 
 # Communicate with door locks.
@@ -781,41 +1764,70 @@ class DoorMonitor(KillableThread):
         self.flush_backlog = True
         self.last_door_state = None
         self.keys = None
+        # Keys last acknowledged by the device, in device order
+        self.dev_keys = None
         self.seen_kp = None
         self.otp = ''
         self.otp_expires = None
-        self.current_response = ""
-
-    def dbg(self, msg):
-        dbg("%s: %s" % (self.port_name, msg))
-
-    def read_response(self, block):
-        c = ''
-        while c != '\n':
-            self.check_kill()
-            if not block:
-                self._cond.release()
-            try:
-                c = self.ser.read()
-            finally:
-                if not block:
-                    self._cond.acquire()
-            if c == "":
-                if block:
-                    raise Exception("No response from %s" % self.port_name)
-                return None
-            self.current_response += c
-        r = self.current_response
-        self.current_response = ""
-        self.dbg("Response: %s" % r[:-1])
-        if len(r) < 5:
-            return None
-        if r[0] == '#':
-            return None
-        crc = r[-5:-1]
-        r = r[:-5]
-        if crc != crc_str(r):
-            raise Exception("CRC mismatch (exp %s got %s)" % (crc, crc_str(r)))
+        # Received bytes, parsed up to rx_pos
+        self.rx_buf = bytearray()
+        self.rx_pos = 0
+        self.codec = ASCII_CODEC
+        self.binary_failed = 0
+        self.crc_errors = 0
+        self.features = None
+        self.next_ping = 0
+        # Time of the first notification not yet handled by work()
+        self.event_time = None
+        self.open_count = 0
+        self.open_latency_total = 0.0
+        self.open_latency_max = 0.0
+        self.cmd_rtt = Histogram()
+        self.resyncs = 0
+        self.resync_time = Histogram()
+        self.log_entries = 0
+        self.log_packets = 0
+        self.log_backlog_max = 0
+        self.log_drain_time = Histogram()
+        self.baud = SERIAL_BAUD
+        # Rate last negotiated, which the device may still be using
+        self.last_baud = SERIAL_BAUD
+        self.baud_failed = 0
+
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("%s: %s" % (self.port_name, msg), level)
+
+    # Read whatever has arrived, waiting up to the serial timeout for
+    # the first byte.  Returns False if nothing arrived in time.
+    def fill_buffer(self):
+        fd = self.ser.fileno()
+        end = time.time() + SERIAL_POLL_PERIOD
+        while True:
+            timeout = end - time.time()
+            if timeout <= 0:
+                return False
+            if fd in self.wait_fds([fd], timeout):
+                break
+        # A device that has gone away reports readiness, and read() then
+        # raises SerialException, which run() handles by resyncing
+        data = self.ser.read(max(self.ser.inWaiting(), 1))
+        if self.rx_pos > 0:
+            del self.rx_buf[:self.rx_pos]
+            self.rx_pos = 0
+        self.rx_buf += data
+        return True
+
+    def flush_rx(self):
+        self.rx_buf = bytearray()
+        self.rx_pos = 0
+
+    # Handle one received message.  Returns the message if it is a
+    # response, or None for async notifications.
+    def parse_frame(self, r):
+        if log_level >= LOG_TRACE:
+            self.dbg("Response: %r" % r, LOG_TRACE)
+        if r[0] in "EY" and self.event_time is None:
+            self.event_time = time.time()
         if r[0] == 'E':
             self.seen_event = True;
         elif r[0] == 'Y':
@@ -827,14 +1839,39 @@ class DoorMonitor(KillableThread):
             return r
         return None
 
+    # Returns the next response frame already in the receive buffer
+    def next_frame(self):
+        while True:
+            f = self.codec.next_frame(self.rx_buf, self.rx_pos)
+            if f is None:
+                return None
+            (self.rx_pos, msg, crc_ok) = f
+            if not crc_ok:
+                self.crc_errors += 1
+                raise Exception("CRC mismatch")
+            if msg is None:
+                continue
+            r = self.parse_frame(msg)
+            if r is not None:
+                return r
+
+    # Returns the next response frame, handling any async notifications
+    # that arrive first
+    def read_response(self):
+        while True:
+            r = self.next_frame()
+            if r is not None:
+                return r
+            if not self.fill_buffer():
+                raise Exception("No response from %s" % self.port_name)
+
     def do_cmd(self, cmd):
-        self.dbg("Sending %s" % cmd)
-        self.ser.write(cmd)
-        self.ser.write(crc_str(cmd))
-        self.ser.write("\n")
-        r = None
-        while r is None:
-            r = self.read_response(True)
+        if log_level >= LOG_TRACE:
+            self.dbg("Sending %r" % cmd, LOG_TRACE)
+        t = time.time()
+        self.ser.write(self.codec.encode(cmd))
+        r = self.read_response()
+        self.cmd_rtt.observe(time.time() - t)
         return r
 
     def do_cmd_expect(self, cmd, response, error):
@@ -843,80 +1880,221 @@ class DoorMonitor(KillableThread):
             raise Exception(error)
 
     def send_ping(self):
-        t = encoded_time()
+        t = self.codec.encode_time(int(time.time()))
         self.do_cmd_expect("P0" + t, "P1" + t, "Machine does not go ping")
 
+    # Enumerate devices.  A device keeps a negotiated rate until it misses
+    # pings, so if it does not answer also try the rate we last set.
+    # "X\n" puts the device back to ASCII framing.
+    def enumerate(self):
+        try:
+            self.do_cmd_expect("S0", "S1", "Device not accepting address")
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:
+            if self.baud == self.last_baud:
+                raise
+            self.dbg("%s, trying %d baud" % (e, self.last_baud))
+            self.ser.baudrate = self.last_baud
+            self.baud = self.last_baud
+            self.codec = ASCII_CODEC
+            self.flush_rx()
+            self.ser.write("X\n")
+            self.do_cmd_expect("S0", "S1", "Device not accepting address")
+
+    # The device answers at the old rate, then goes back to SERIAL_BAUD
+    # unless it is pinged at the new rate within SERIAL_BAUD_CONFIRM
+    def set_baud(self, baud):
+        self.dbg("Switching to %d baud" % baud)
+        self.do_cmd_expect("B0%d" % baud, "A0", "Device refused %d baud" % baud)
+        self.ser.baudrate = baud
+        self.baud = baud
+        self.last_baud = baud
+        self.flush_rx()
+        try:
+            self.send_ping()
+        except KeyboardInterrupt:
+            raise
+        except BaseException:
+            # Give the device time to go back to SERIAL_BAUD too
+            self.ser.baudrate = SERIAL_BAUD
+            self.baud = SERIAL_BAUD
+            self.last_baud = SERIAL_BAUD
+            self.baud_failed = time.time()
+            self.delay(SERIAL_BAUD_CONFIRM)
+            raise
+
+    # The device acknowledges in ASCII, then stays in binary framing until
+    # it sees "X\n" or misses pings
+    def set_binary(self):
+        self.dbg("Switching to binary framing")
+        self.do_cmd_expect("W0B", "A0", "Device refused binary framing")
+        self.codec = BINARY_CODEC
+        self.flush_rx()
+        try:
+            self.send_ping()
+        except KeyboardInterrupt:
+            raise
+        except BaseException:
+            self.codec = ASCII_CODEC
+            self.binary_failed = time.time()
+            self.ser.write("X\n")
+            raise
+
+    # Older firmware passes unknown commands through unchanged,
+    # so reports no features
+    def get_features(self):
+        r = self.do_cmd("F0")
+        if r[:2] != "F0":
+            raise Exception("Bad feature response")
+        self.features = r[2:]
+        self.dbg("Features '%s'" % self.features)
+
+    def upload_keys(self):
+        self.dbg("Uploading keys")
+        self.do_cmd_expect("R0", "A0", "Device key reset failed")
+        if "M" in self.features:
+            for frame in key_frames("M0", self.keys):
+                self.do_cmd_expect(frame, "A0", "Device not accepting keys")
+        else:
+            for key in self.keys:
+                self.do_cmd_expect("N0" + key, "A0", "Device not accepting keys")
+        self.do_cmd_expect("K0", "H0" + self.key_hash(self.keys),
+                "Key upload corrupt")
+        return list(self.keys)
+
+    # Send only the keys added or removed since the last sync.
+    # The device keeps the order of remaining keys and appends new ones.
+    # Returns the new device key list.
+    def update_keys(self, dev_keys):
+        want = set(self.keys)
+        have = set(dev_keys)
+        removed = [k.split(' ')[0] for k in dev_keys if k not in want]
+        added = [k for k in self.keys if k not in have]
+        self.dbg("Updating keys (-%d +%d)" % (len(removed), len(added)))
+        for frame in key_frames("D0", removed):
+            self.do_cmd_expect(frame, "A0", "Device not removing keys")
+        for frame in key_frames("M0", added):
+            self.do_cmd_expect(frame, "A0", "Device not accepting keys")
+        return [k for k in dev_keys if k in want] + added
+
+    def resync_keys(self):
+        r = self.do_cmd("K0")
+        dev_keys = self.dev_keys
+        if dev_keys is None or r != "H0" + self.key_hash(dev_keys):
+            if r == "H0" + self.key_hash(self.keys):
+                dev_keys = list(self.keys)
+            else:
+                dev_keys = None
+        if dev_keys is not None and set(dev_keys) != set(self.keys):
+            if "D" in self.features and "M" in self.features:
+                self.dev_keys = None
+                dev_keys = self.update_keys(dev_keys)
+                r = self.do_cmd("K0")
+                if r != "H0" + self.key_hash(dev_keys):
+                    self.dbg("Key update mismatch")
+                    dev_keys = None
+            else:
+                dev_keys = None
+        if dev_keys is None:
+            self.dev_keys = None
+            t = time.time()
+            dev_keys = self.upload_keys()
+            self.dbg("Uploaded %d keys in %.1fs"
+                    % (len(self.keys), time.time() - t))
+        self.dev_keys = dev_keys
+
     def resync(self):
         self.dbg("Resync")
+        self.resyncs += 1
+        t = time.time()
         if self.ser is None:
             self.ser = OpenSerial("/dev/" + self.port_name)
+            self.baud = SERIAL_BAUD
+            self.codec = ASCII_CODEC
+            self.features = None
             self.ser.write("X\n")
             # Wait for a 1s quiet period
             while self.ser.inWaiting():
                 while self.ser.inWaiting():
-                    self.ser.read(1)
-                time.sleep(1)
+                    self.ser.read(self.ser.inWaiting())
+                self.delay(1)
+            self.flush_rx()
 
-        # Enumerate devices
-        self.do_cmd_expect("S0", "S1", "Device not accepting address")
+        self.enumerate()
         self.send_ping()
-        hash_result = "H0" + self.key_hash()
-        r = self.do_cmd("K0")
-        if r != hash_result:
-            self.dbg("Uploading keys")
-            self.do_cmd_expect("R0", "A0", "Device key reset failed")
-            for key in self.keys:
-                self.do_cmd_expect("N0" + key, "A0", "Device not accepting keys")
-            self.do_cmd_expect("K0", hash_result, "Key upload corrupt")
+        if self.features is None:
+            self.get_features()
+        if "B" in self.features:
+            baud = want_baud(self.g.config, self.port_name, self.baud_failed)
+            if baud != self.baud:
+                self.set_baud(baud)
+        if "W" in self.features and self.codec is not BINARY_CODEC:
+            if want_binary(self.g.config, self.port_name, self.binary_failed):
+                self.set_binary()
+        self.resync_keys()
         self.sync = True
         self.flush_backlog = True
+        self.resync_time.observe(time.time() - t)
 
-    def poll_event(self):
-        if not self.sync:
-            if self.seen_event:
-                return True;
-            self.wait(SERIAL_POLL_PERIOD);
-            return False;
-        r = self.read_response(False)
-        if r is not None:
-            raise Exception("Unexpected spontaneous response");
-        return self.seen_event or (self.seen_kp is not None)
-
-    def key_hash(self):
+    # Wait until there is something for work() to do: a notification from
+    # the device, a wakeup from another thread or the next ping deadline.
+    # The serial port is only watched while in sync.
+    def wait_event(self):
+        while True:
+            self.check_kill()
+            # Notifications may have arrived in the same read as the last
+            # response
+            if self.sync and self.next_frame() is not None:
+                raise Exception("Unexpected spontaneous response");
+            if self.seen_event or self.seen_kp is not None:
+                return
+            timeout = self.next_ping - time.time()
+            if timeout <= 0:
+                self.seen_event = True
+                return
+            fds = []
+            if self.sync:
+                fds.append(self.ser.fileno())
+            ready = self.wait_fds(fds, timeout, True)
+            if self.sync and self.ser.fileno() in ready:
+                self.fill_buffer()
+
+    def key_hash(self, keys):
         crc = 0
-        for key in self.keys:
+        for key in keys:
             crc = crc16.crc16xmodem(key, crc)
             crc = crc16.crc16xmodem(chr(0), crc)
-        self.dbg("key hash %04X" % crc)
-        return "%04X" % crc
+        self.dbg("key hash %04X" % crc, LOG_TRACE)
+        return self.codec.encode_hash(crc)
 
-    def handle_log(self, msg):
-        if len(msg) < 7:
+    def handle_log(self, rec):
+        r = self.codec.decode_log(rec)
+        if r is None:
             self.dbg("Log message too short")
             return
-        t = decode_time(msg[0:6])
-        action = msg[6]
-        tag = msg[7:]
+        (t, action, tag) = r
+        self.dbg("Log event: %d %s %s" % (t, action, tag))
         lt = time.localtime(t)
         if action == 'R':
             astr = "Rejected"
         elif action == 'U':
             if not self.flush_backlog:
-                g.dbt.do_tag_in(tag);
+                schedule(g.dbt.do_tag_in, tag)
             astr = "Unlocked"
         elif action == 'P':
             astr = "BadPIN"
         elif action == 'O':
             astr = "Opened"
-            g.dbt.set_door_state(self.port_name, True)
+            schedule(g.dbt.set_door_state, self.port_name, True)
         elif action == 'C':
             astr = "Closed"
-            g.dbt.set_door_state(self.port_name, False)
+            schedule(g.dbt.set_door_state, self.port_name, False)
         elif action == 'B':
             astr = "Button"
         elif action == 'T':
             astr = "Scanout"
-            g.dbt.do_tag_out(tag);
+            schedule(g.dbt.do_tag_out, tag)
         elif action == 'Q':
             astr = "Query"
         else:
@@ -926,32 +2104,58 @@ class DoorMonitor(KillableThread):
         if (action == 'R' or action == 'Q') and not self.flush_backlog:
             # Allow all member tags if space is open
             if g.dbt.query_override(tag):
-                g.dbt.do_tag_in(tag);
+                schedule(g.dbt.do_tag_in, tag)
                 self.remote_open = True;
 
+    # Read and clear the event log.  Firmware with the 'L' feature packs
+    # as many whole records as fit into each reply, so one L0/C0 pair
+    # drains several records.  Older firmware needs a G0/C0 pair per
+    # record.
+    def drain_log(self):
+        t = time.time()
+        entries = 0
+        packets = 0
+        if "L" in self.features:
+            get = "L0"
+        else:
+            get = "G0"
+        while True:
+            r = self.do_cmd(get)
+            if r[:2] != "V0":
+                raise Exception("Failed to get event log")
+            if len(r) == 2:
+                break
+            packets += 1
+            for rec in self.codec.split_log(r[2:], get == "L0"):
+                self.handle_log(rec)
+                entries += 1
+            self.do_cmd_expect("C0", "A0", "Error clearing event log")
+        if entries == 0:
+            return
+        elapsed = time.time() - t
+        self.log_entries += entries
+        self.log_packets += packets
+        self.log_backlog_max = max(self.log_backlog_max, entries)
+        self.log_drain_time.observe(elapsed)
+        self.dbg("Drained %d log entries in %d packets in %.1fms"
+                % (entries, packets, elapsed * 1000.0))
+
     def work(self):
         self.dbg("Working")
         if self.seen_event:
             self.seen_event = False
+            self.next_ping = time.time() + SERIAL_PING_INTERVAL
             if self.sync:
                 self.send_ping()
             else:
                 self.resync()
-            while True:
-                r = self.do_cmd("G0")
-                if r[:2] != "V0":
-                    raise Exception("Failed to get event log")
-                if len(r) == 2:
-                    break
-                self.dbg("Log event: %s" % r[2:])
-                self.handle_log(r[2:])
-                self.do_cmd_expect("C0", "A0", "Error clearing event log")
+            self.drain_log()
             self.flush_backlog = False
         if self.seen_kp is not None:
             c = self.seen_kp
             self.seen_kp = None
             if c == '*':
-                g.dbt.seen_star(self.port_name)
+                schedule(g.dbt.seen_star, self.port_name)
             elif c != '#':
                 c = self.otp + c;
                 self.otp = c
@@ -963,6 +2167,14 @@ class DoorMonitor(KillableThread):
         if self.remote_open:
             self.remote_open = False
             self.do_cmd_expect("U0", "A0", "Error doing remote open")
+            if self.event_time is not None:
+                lat = time.time() - self.event_time
+                self.open_count += 1
+                self.open_latency_total += lat
+                self.open_latency_max = max(self.open_latency_max, lat)
+                self.dbg("Remote open %.1fms after notification"
+                        % (lat * 1000.0))
+        self.event_time = None
         if self.otp_expires is not None:
             if self.otp_expires < time.time():
                 self.dbg("OTP expired")
@@ -976,6 +2188,7 @@ class DoorMonitor(KillableThread):
             self.keys = keys
             self.sync = False
             self.seen_event = True
+        self.wakeup()
 
     def run(self):
         while self.keys is None:
@@ -985,11 +2198,7 @@ class DoorMonitor(KillableThread):
                 try:
                     self.check_kill()
                     self.work()
-                    timeout = 0.0
-                    while not self.poll_event():
-                        timeout += SERIAL_POLL_PERIOD
-                        if timeout >= SERIAL_PING_INTERVAL:
-                                self.seen_event = True
+                    self.wait_event()
                 except KeyboardInterrupt:
                     # We use KeyboardInterrupt for thread termination
                     self.dbg("Stopped")
@@ -999,6 +2208,12 @@ class DoorMonitor(KillableThread):
                     break
                 except BaseException as e:
                     self.dbg(str(e))
+                    if self.baud != SERIAL_BAUD:
+                        self.dbg("Falling back to %d baud" % SERIAL_BAUD)
+                        self.baud_failed = time.time()
+                    if self.codec is BINARY_CODEC:
+                        self.dbg("Falling back to ASCII framing")
+                        self.binary_failed = time.time()
                     if self.ser is not None:
                         CloseSerial(self.ser)
                         self.ser = None
@@ -1006,74 +2221,303 @@ class DoorMonitor(KillableThread):
                 except:
                     raise
 
+# Translate an mpc style command line into an MPD protocol command
+def mpd_command(cmd):
+    words = cmd.split(None, 1)
+    if words[0] == "volume" and not mpd_relative(cmd):
+        words[0] = "setvol"
+    else:
+        words[0] = mpc_commands.get(words[0], words[0])
+    return " ".join(words)
+
+# "volume +5" or "volume -5", which MPD's own volume command takes as is
+def mpd_relative(cmd):
+    words = cmd.split()
+    return words[0] == "volume" and len(words) > 1 and words[1][:1] in "+-"
+
+
+# Talks to the hifi's MPD server directly, over a persistent connection.
+# Commands queued while one batch is being sent go out together as a
+# command list, with redundant ones dropped.
 class HifiMonitor(KillableThread):
     def __init__(self, g):
         super(HifiMonitor, self).__init__()
         self.g = g
-        self.pending = None
-
-    def dbg(self, msg):
-        dbg("hifi: %s" % (msg))
+        self.pending = []
+        self.sock = None
+        self.rfile = None
+        self.commands = 0
+        self.batches = 0
+        self.collapsed = 0
+        self.connects = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("hifi: %s" % (msg), level)
 
     # Can be called from other threads
+    # Only commands whose effect does not depend on how often they run
+    # are merged: one from mpd_replace replaces its earlier copies, and a
+    # playback command replaces any pending playback command.  Relative
+    # volume changes, next, prev and toggle are all kept, in order.
     def cmd(self, cmd):
         with self:
-            self.pending = cmd
+            name = cmd.split()[0]
+            replace = name in mpd_replace and not mpd_relative(cmd)
+            keep = []
+            for c in self.pending:
+                other = c.split()[0]
+                if (replace and other == name) \
+                        or (other in mpd_playback and name in mpd_playback):
+                    self.collapsed += 1
+                else:
+                    keep.append(c)
+            keep.append(cmd)
+            self.pending = keep
             self.notify()
 
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+            self.rfile = None
+
+    def connect(self):
+        self.sock = socket.create_connection((MPD_HOST, MPD_PORT), MPD_TIMEOUT)
+        self.rfile = self.sock.makefile("rb")
+        hello = self.rfile.readline()
+        if not hello.startswith("OK MPD "):
+            self.close()
+            raise Exception("Bad MPD greeting '%s'" % hello.rstrip())
+        self.connects += 1
+        self.dbg("Connected to %s (connects=%d)" % (hello[3:].rstrip(),
+            self.connects))
+
+    # MPD sends nothing unprompted, so a readable socket means the server
+    # has closed the connection (it does so after a period of idleness)
+    def check_connection(self):
+        if self.sock is None:
+            return
+        if len(select.select([self.sock], [], [], 0)[0]) > 0:
+            self.dbg("Connection closed by server")
+            self.close()
+
+    # Send the commands in one go and wait for the final OK
+    def execute(self, cmds):
+        if len(cmds) == 1:
+            data = cmds[0] + "\n"
+        else:
+            data = "command_list_begin\n" \
+                    + "".join([c + "\n" for c in cmds]) \
+                    + "command_list_end\n"
+        self.sock.sendall(data)
+        while True:
+            l = self.rfile.readline()
+            if l == "":
+                raise socket.error("Connection closed")
+            if l == "OK\n":
+                return
+            if l.startswith("ACK "):
+                self.errors += 1
+                self.dbg("Command failed: %s" % l.rstrip())
+                return
+
     def run(self):
         while True:
             try:
-                self.check_kill()
                 with self:
-                    while self.pending is None:
+                    while len(self.pending) == 0:
                         self.wait()
-                    cmd = self.pending
-                    self.pending = None
-                os.system("/usr/bin/mpc -h wifihifi %s" % cmd)
+                    cmds = [mpd_command(c) for c in self.pending]
+                    self.pending = []
+                t = time.time()
+                self.check_connection()
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.execute(cmds)
+                except socket.error as e:
+                    # Reconnect and try once more
+                    self.dbg("%s, reconnecting" % e)
+                    self.close()
+                    self.connect()
+                    self.execute(cmds)
+                lat = time.time() - t
+                self.commands += len(cmds)
+                self.batches += 1
+                self.latency_total += lat
+                self.latency_max = max(self.latency_max, lat)
+                self.dbg("%s in %.1fms" % (", ".join(cmds), lat * 1000))
             except KeyboardInterrupt:
                 self.dbg("Stopped")
+                self.close()
                 break
             except BaseException as e:
+                self.close()
                 dbg(str(e))
             except:
                 pass
 
+# Sends messages to the IRC bot over a persistent connection.
+# Messages sent with a key (e.g. "space") are held for IRC_COALESCE_WINDOW
+# and only the latest one for that key is sent, and then only if it
+# differs from the last one sent, so flapping states don't spam the channel.
 class IRCSpammer(KillableThread):
     def __init__(self, g):
         super(IRCSpammer, self).__init__()
         self.g = g
-        self.msgq = []
+        # (message, time queued)
+        self.msgq = collections.deque()
+        # key -> (message, time queued, release time)
+        self.held = {}
+        self.last_keyed = {}
+        self.sock = None
+        self.last_used = 0
+        self.backoff = IRC_BACKOFF_MIN
+        self.tokens = IRC_RATE_BURST
+        self.tokens_time = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.connects = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("irc: %s" % (msg), level)
+
+    # Assumes lock is already held
+    def _queue(self, msg, t):
+        if len(self.msgq) >= IRC_QUEUE_SIZE:
+            self.msgq.popleft()
+            self.dropped += 1
+        self.msgq.append((msg, t))
 
-    def send(self, msg):
+    def send(self, msg, key=None):
         with self:
-            self.msgq.append(msg)
+            t = time.time()
+            if key is None:
+                self._queue(msg, t)
+            elif key in self.held:
+                self.coalesced += 1
+                (old, queued, release) = self.held[key]
+                self.held[key] = (msg, queued, release)
+            else:
+                self.held[key] = (msg, t, t + IRC_COALESCE_WINDOW)
             self.notify()
 
-    def really_send(self, msg):
+    # Assumes lock is already held.  Moves held messages whose window has
+    # passed to the queue.  Returns the time until the next one is due.
+    def _release_held(self):
+        now = time.time()
+        timeout = None
+        for key, (msg, queued, release) in self.held.items():
+            if release > now:
+                if timeout is None or release - now < timeout:
+                    timeout = release - now
+                continue
+            del self.held[key]
+            if self.last_keyed.get(key) == msg:
+                self.coalesced += 1
+                continue
+            self.last_keyed[key] = msg
+            self._queue(msg, queued)
+        return timeout
+
+    # Assumes lock is already held.  Returns 0 if a message may be sent
+    # now, otherwise how long until one can be.
+    def _rate_wait(self):
+        now = time.time()
+        self.tokens = min(IRC_RATE_BURST,
+                self.tokens + (now - self.tokens_time) * IRC_RATE)
+        self.tokens_time = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / IRC_RATE
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def connect(self):
         address = (self.g.config.get("ircbot", "msghost"), self.g.config.get("ircbot", "msgport"))
+        self.sock = socket.create_connection(address, IRC_TIMEOUT)
+        self.connects += 1
+        self.dbg("Connected (connects=%d)" % self.connects)
+
+    # The bot never sends anything, so a readable socket means it has
+    # closed the connection (or sent something we don't understand)
+    def check_connection(self):
+        if self.sock is None:
+            return
+        if len(select.select([self.sock], [], [], 0)[0]) > 0:
+            self.dbg("Connection closed by bot")
+            self.close()
+
+    def really_send(self, msg):
         channel = self.g.config.get("ircbot", "msgchannel")
-        s = socket.create_connection(address, IRC_TIMEOUT)
+        self.check_connection()
+        if self.sock is None:
+            self.connect()
         try:
-            s.sendall("%s %s\n" % (channel, msg))
-            s.shutdown(socket.SHUT_RDWR)
-        finally:
-            s.close()
+            self.sock.sendall("%s %s\n" % (channel, msg))
+        except:
+            self.close()
+            raise
+        self.last_used = time.time()
 
     def run(self):
         while True:
             try:
                 with self:
-                    self.check_kill()
-                    while len(self.msgq) == 0:
-                        self.wait()
-                    msg = self.msgq.pop(0);
-                self.really_send(msg)
+                    while True:
+                        self.check_kill()
+                        timeout = self._release_held()
+                        if len(self.msgq) > 0:
+                            wait = self._rate_wait()
+                            if wait == 0:
+                                break
+                            if timeout is None or wait < timeout:
+                                timeout = wait
+                        elif self.sock is not None:
+                            idle = self.last_used + IRC_IDLE_TIMEOUT - time.time()
+                            if idle <= 0:
+                                self.dbg("Closing idle connection")
+                                self.close()
+                            elif timeout is None or idle < timeout:
+                                timeout = idle
+                        self.wait(timeout)
+                    (msg, queued) = self.msgq.popleft()
+                    self.tokens -= 1
+                try:
+                    self.really_send(msg)
+                except KeyboardInterrupt:
+                    raise
+                except BaseException as e:
+                    # Put it back and retry after a delay
+                    with self:
+                        self.msgq.appendleft((msg, queued))
+                    self.dbg("%s, retrying in %ds" % (e, self.backoff))
+                    self.delay(self.backoff)
+                    self.backoff = min(self.backoff * 2, IRC_BACKOFF_MAX)
+                    continue
+                self.backoff = IRC_BACKOFF_MIN
+                lat = time.time() - queued
+                self.sent += 1
+                self.latency_total += lat
+                self.latency_max = max(self.latency_max, lat)
+                self.dbg("Sent '%s' after %.1fms" % (msg, lat * 1000),
+                        LOG_TRACE)
             except KeyboardInterrupt:
-                dbg("irc: Stopped")
+                self.dbg("Stopped")
+                self.close()
                 break
             except BaseException as e:
-                dbg("irc:" + str(e))
+                self.dbg(str(e))
             except:
                 pass
 
@@ -1084,12 +2528,20 @@ class ARPMonitor(KillableThread):
         self.current_ip = set()
         self.current_mac = set()
         self.ping_pending = set()
+        # Addresses currently being pinged
+        self.probing = set()
+        self.probe_count = 0
+        self.probe_alive = 0
+        self.probe_time_max = 0.0
 
-    def dbg(self, msg):
-        dbg("arp: %s" % (msg))
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("arp: %s" % (msg), level)
 
     def scan_arp(self):
         self.g.schedule_delay(self.scan_arp, ARP_SCAN_INTERVAL)
+        self.read_arp()
+
+    def read_arp(self):
         with self:
             self.dbg("scanning table")
             new_ip = set()
@@ -1108,30 +2560,88 @@ class ARPMonitor(KillableThread):
                         mac_map[mac] = ip
             missing_ip = self.current_ip - new_ip
             self.current_ip = new_ip
+            missing_ip -= self.probing
             if len(missing_ip) > 0:
                 self.ping_pending |= missing_ip
                 self.notify()
             new_mac = set(mac_map.keys())
-            self.g.dbt.update_arp_entries(new_mac)
-            unseen_mac = new_mac - self.current_mac
+            unseen = [(m, mac_map[m]) for m in new_mac - self.current_mac]
+            self.g.dbt.update_arp_entries(new_mac, unseen)
             self.current_mac = new_mac
-            for m in unseen_mac:
-                schedule(self.g.dbt.check_bogon, m, mac_map[m])
+
+    # Called from the main thread when NeighMonitor sees a usable entry
+    def neigh_found(self, ip, mac):
+        with self:
+            self.current_ip.add(ip)
+            if mac in self.current_mac:
+                return
+            self.dbg("%s (%s) arrived" % (mac, ip))
+            self.g.dbt.update_arp_entries(set([mac]), [(mac, ip)])
+            self.current_mac.add(mac)
+
+    # Called from the main thread when NeighMonitor sees an entry fail
+    # or be removed
+    def neigh_lost(self, ip):
+        with self:
+            if ip not in self.current_ip:
+                return
+            self.dbg("%s gone" % ip)
+            self.current_ip.discard(ip)
+            if ip not in self.probing:
+                self.ping_pending.add(ip)
+                self.notify()
 
     def ping(self, ip):
         self.dbg("Pinging %s" % ip)
-        try:
-            p = subprocess.Popen(["ping", "-c", "1", "-W", "5", ip], \
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            p.communicate()
-            p.wait()
-        except:
-            self.dbg("ping failed")
+        return subprocess.Popen( \
+                ["ping", "-c", "1", "-W", str(ARP_PROBE_TIMEOUT), ip], \
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                close_fds=True)
 
+    # Ping the addresses in pending, ARP_PROBE_WORKERS at a time.
+    # Returns the set that replied.
     def ping_all(self, pending):
-        for ip in pending:
-            self.check_kill()
-            self.ping(ip)
+        queue = list(pending)
+        # stdout fd -> (ip, process, start time)
+        running = {}
+        alive = set()
+        t = time.time()
+        try:
+            while len(queue) > 0 or len(running) > 0:
+                while len(queue) > 0 and len(running) < ARP_PROBE_WORKERS:
+                    ip = queue.pop()
+                    try:
+                        p = self.ping(ip)
+                    except OSError as e:
+                        self.dbg("ping failed: %s" % e)
+                        continue
+                    running[p.stdout.fileno()] = (ip, p, time.time())
+                if len(running) == 0:
+                    continue
+                for fd in self.wait_fds(running.keys(), ARP_PROBE_TIMEOUT):
+                    # Readable at EOF, which is when ping exits
+                    if os.read(fd, 4096) != "":
+                        continue
+                    (ip, p, start) = running.pop(fd)
+                    p.stdout.close()
+                    rc = p.wait()
+                    lat = time.time() - start
+                    self.probe_count += 1
+                    self.probe_time_max = max(self.probe_time_max, lat)
+                    if rc == 0:
+                        self.probe_alive += 1
+                        alive.add(ip)
+                        self.dbg("%s replied in %.2fs" % (ip, lat))
+                    else:
+                        self.dbg("%s did not reply" % ip)
+        finally:
+            for (ip, p, start) in running.values():
+                p.kill()
+                p.wait()
+                p.stdout.close()
+        self.dbg("Pinged %d hosts in %.1fs, %d replied"
+                % (len(pending), time.time() - t, len(alive)))
+        return alive
 
     def run(self):
         schedule(self.scan_arp)
@@ -1142,7 +2652,16 @@ class ARPMonitor(KillableThread):
                     self.ping_pending = set()
                     if len(pending) == 0:
                         self.wait()
-                self.ping_all(pending)
+                        continue
+                    self.probing = pending
+                try:
+                    alive = self.ping_all(pending)
+                finally:
+                    with self:
+                        self.probing = set()
+                # Hosts that replied are back in the ARP table
+                if len(alive) > 0:
+                    schedule_once(self.read_arp)
             except KeyboardInterrupt:
                 self.dbg("Stopped")
                 break;
@@ -1151,23 +2670,310 @@ class ARPMonitor(KillableThread):
             except:
                 self.dbg("Wonky exception")
 
+# Decode rtnetlink neighbour messages.
+# Returns a list of (message type, ip, mac, state) for IPv4 entries;
+# mac is None if the message has no link layer address.
+def parse_neigh(data):
+    events = []
+    off = 0
+    while off + NLMSG_HDR_LEN <= len(data):
+        (length, msg_type, flags, seq, pid) = \
+                struct.unpack_from(NLMSG_HDR, data, off)
+        if length < NLMSG_HDR_LEN or off + length > len(data):
+            break
+        end = off + length
+        if (msg_type == RTM_NEWNEIGH or msg_type == RTM_DELNEIGH) \
+                and length >= NLMSG_HDR_LEN + NDMSG_LEN:
+            (family, ifindex, state, nflags, ntype) = \
+                    struct.unpack_from(NDMSG, data, off + NLMSG_HDR_LEN)
+            ip = None
+            mac = None
+            a = off + NLMSG_HDR_LEN + NDMSG_LEN
+            while a + 4 <= end:
+                (alen, atype) = struct.unpack_from("=HH", data, a)
+                if alen < 4 or a + alen > end:
+                    break
+                payload = data[a + 4:a + alen]
+                if atype == NDA_DST and len(payload) == 4:
+                    ip = socket.inet_ntoa(payload)
+                elif atype == NDA_LLADDR and len(payload) == 6:
+                    mac = ":".join(["%02x" % ord(c) for c in payload])
+                a += (alen + 3) & ~3
+            if family == socket.AF_INET and ip is not None:
+                events.append((msg_type, ip, mac, state))
+        off += (length + 3) & ~3
+    return events
+
+# Optional companion to ARPMonitor.  Listens for kernel neighbour table
+# changes so arrivals and departures are seen straight away rather than
+# at the next scan.  ARPMonitor's periodic scans still run, and are what
+# keeps presence deadlines of devices that stay put up to date.
+class NeighMonitor(KillableThread):
+    def __init__(self, g):
+        super(NeighMonitor, self).__init__()
+        self.g = g
+        self.sock = None
+        self.events = 0
+        self.overruns = 0
+
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("neigh: %s" % (msg), level)
+
+    def handle(self, msg_type, ip, mac, state):
+        self.events += 1
+        if log_level >= LOG_TRACE:
+            self.dbg("%d %s %s %02x" % (msg_type, ip, mac, state), LOG_TRACE)
+        if msg_type == RTM_DELNEIGH or (state & (NUD_FAILED | NUD_INCOMPLETE)):
+            schedule(self.g.arp.neigh_lost, ip)
+        elif (state & NUD_VALID) and mac is not None \
+                and mac != '00:00:00:00:00:00':
+            schedule(self.g.arp.neigh_found, ip, mac)
+
+    def run(self):
+        while True:
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_NETLINK,
+                            socket.SOCK_RAW, NETLINK_ROUTE)
+                    self.sock.bind((0, RTMGRP_NEIGH))
+                    self.dbg("Listening")
+                self.wait_fds([self.sock.fileno()], None)
+                try:
+                    data = self.sock.recv(65536)
+                except socket.error as e:
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    # Notifications were lost, so catch up with a full scan
+                    self.overruns += 1
+                    self.dbg("Receive buffer overrun")
+                    schedule_once(self.g.arp.read_arp)
+                    continue
+                for ev in parse_neigh(data):
+                    self.handle(*ev)
+            except KeyboardInterrupt:
+                self.dbg("Stopped")
+                break
+            except BaseException as e:
+                self.dbg(str(e))
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                try:
+                    self.delay(ARP_SCAN_INTERVAL)
+                except KeyboardInterrupt:
+                    break
+
+# Builds a page in the Prometheus text exposition format.
+# Samples are grouped by metric, whatever order they are added in.
+class MetricsPage(object):
+    def __init__(self):
+        # name -> (type, [sample lines])
+        self.metrics = collections.OrderedDict()
+
+    def _add(self, name, mtype, suffix, labels, val):
+        name = "doord_" + name
+        if name not in self.metrics:
+            self.metrics[name] = (mtype, [])
+        if labels:
+            lstr = "{%s}" % ",".join(['%s="%s"' % (k, labels[k])
+                for k in sorted(labels.keys())])
+        else:
+            lstr = ""
+        self.metrics[name][1].append("%s%s%s %s" % (name, suffix, lstr, val))
+
+    def gauge(self, name, val, labels=None):
+        self._add(name, "gauge", "", labels, float(val))
+
+    def counter(self, name, val, labels=None):
+        self._add(name, "counter", "", labels, float(val))
+
+    def histogram(self, name, hist, labels=None):
+        if labels is None:
+            labels = {}
+        (buckets, count, total) = hist.snapshot()
+        for (bound, n) in buckets + [("+Inf", count)]:
+            l = dict(labels)
+            l["le"] = bound
+            self._add(name, "histogram", "_bucket", l, n)
+        self._add(name, "histogram", "_count", labels, count)
+        self._add(name, "histogram", "_sum", labels, total)
+
+    def text(self):
+        lines = []
+        for (name, (mtype, samples)) in self.metrics.items():
+            lines.append("# TYPE %s %s" % (name, mtype))
+            lines += samples
+        return "\n".join(lines) + "\n"
+
+# Collect the current state of everything into a MetricsPage.
+# Reads counters without taking thread locks, so values may be a little
+# inconsistent with each other.
+def collect_metrics(g):
+    m = MetricsPage()
+    for t in g.threads:
+        name = getattr(t, "port_name", t.__class__.__name__)
+        m.gauge("thread_alive", t.is_alive(), {"thread": name})
+    m.gauge("scheduler_queue_depth", g.queue_depth())
+    m.counter("scheduler_dispatched_total", g.dispatched)
+    m.counter("scheduler_coalesced_total", g.coalesced)
+    m.gauge("scheduler_lag_max_seconds", g.max_lag)
+    m.histogram("scheduler_lag_seconds", g.lag)
+    for door in (g.door_up, g.door_down):
+        l = {"port": door.port_name}
+        m.gauge("door_sync", door.sync, l)
+        m.gauge("serial_baud", door.baud, l)
+        m.gauge("serial_binary_framing", door.codec is BINARY_CODEC, l)
+        m.histogram("serial_rtt_seconds", door.cmd_rtt, l)
+        m.counter("serial_crc_errors_total", door.crc_errors, l)
+        m.counter("door_resyncs_total", door.resyncs, l)
+        m.histogram("door_resync_seconds", door.resync_time, l)
+        m.counter("door_log_entries_total", door.log_entries, l)
+        m.counter("door_log_packets_total", door.log_packets, l)
+        m.gauge("door_log_backlog_max", door.log_backlog_max, l)
+        m.histogram("door_log_drain_seconds", door.log_drain_time, l)
+        m.counter("door_remote_opens_total", door.open_count, l)
+        m.gauge("door_remote_open_latency_max_seconds",
+                door.open_latency_max, l)
+    m.histogram("serial_rtt_seconds", g.aux.cmd_rtt,
+            {"port": g.aux.port_name})
+    m.gauge("serial_baud", g.aux.baud, {"port": g.aux.port_name})
+    m.counter("aux_commands_total", g.aux.commands)
+    m.counter("aux_batches_total", g.aux.batches)
+    dbt = g.dbt
+    for (name, h) in dbt.db_latency.items():
+        m.histogram("db_query_seconds", h, {"method": name})
+    for (name, n) in dbt.db_errors.items():
+        m.counter("db_errors_total", n, {"method": name})
+    m.counter("db_connects_total", dbt.pool.connects)
+    m.counter("db_reconnects_total", dbt.pool.reconnects)
+    m.counter("db_journal_appended_total", dbt.journal.appended)
+    m.counter("db_journal_replayed_total", dbt.journal.replayed)
+    m.counter("db_journal_dropped_total", dbt.journal.dropped)
+    m.gauge("db_journal_bytes", dbt.journal.size())
+    m.counter("db_batch_rows_total", dbt.batch_rows)
+    m.counter("auth_decisions_total", dbt.override_count)
+    m.counter("auth_cached_decisions_total", dbt.override_cached)
+    m.gauge("auth_decision_latency_max_seconds", dbt.override_latency_max)
+    m.counter("presence_statements_total", dbt.presence_statements)
+    m.counter("arp_probes_total", g.arp.probe_count)
+    m.counter("arp_probe_replies_total", g.arp.probe_alive)
+    m.gauge("irc_queue_length", len(g.irc.msgq) + len(g.irc.held))
+    m.counter("irc_sent_total", g.irc.sent)
+    m.counter("irc_dropped_total", g.irc.dropped)
+    m.counter("irc_coalesced_total", g.irc.coalesced)
+    m.gauge("hifi_queue_length", len(g.hifi.pending))
+    m.counter("hifi_commands_total", g.hifi.commands)
+    m.counter("hifi_errors_total", g.hifi.errors)
+    if log_writer is not None:
+        m.counter("log_dropped_total", log_writer.dropped)
+    return m.text()
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Don't let a stalled client hold up the thread for long
+    timeout = 5
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = collect_metrics(self.server.g)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        dbg("metrics: %s" % (fmt % args), LOG_TRACE)
+
+# Serves /metrics over HTTP.  Configured by the [metrics] section of
+# marvin.conf: port, and optionally address (default localhost).
+class MetricsThread(KillableThread):
+    def __init__(self, g):
+        super(MetricsThread, self).__init__()
+        self.g = g
+        self.port = g.config.getint("metrics", "port")
+        if g.config.has_option("metrics", "address"):
+            self.address = g.config.get("metrics", "address")
+        else:
+            self.address = "127.0.0.1"
+
+    def dbg(self, msg, level=LOG_DEBUG):
+        dbg("metrics: %s" % (msg), level)
+
+    def run(self):
+        server = None
+        while True:
+            try:
+                if server is None:
+                    server = BaseHTTPServer.HTTPServer(
+                            (self.address, self.port), MetricsHandler)
+                    server.g = self.g
+                    server.timeout = 0
+                    self.dbg("Listening on %s:%d" % (self.address, self.port))
+                if len(self.wait_fds([server.fileno()], None)) > 0:
+                    server.handle_request()
+            except KeyboardInterrupt:
+                self.dbg("Stopped")
+                break
+            except BaseException as e:
+                self.dbg(str(e))
+                if server is not None:
+                    server.server_close()
+                    server = None
+                try:
+                    self.delay(SERIAL_PING_INTERVAL)
+                except KeyboardInterrupt:
+                    break
+        if server is not None:
+            server.server_close()
+
+# A scheduled function call.  Also serves as the handle returned by
+# Globals.schedule_delay(), which can be used to cancel the call.
 class Closure(object):
     def __init__(self, fn, timeout, args, kwargs):
         self.timeout = timeout
         self._fn = fn
         self._args = args
         self._kwargs = kwargs
+        self.cancelled = False
+        self.key = None
     def __call__(self):
         self._fn(*self._args, **self._kwargs)
     def __str__(self):
         return "<Closure %s %s %s>" % (self._fn, self._args, self._kwargs)
+    def cancel(self):
+        self.cancelled = True
+    # Identity used to coalesce duplicate calls, or None if the
+    # arguments are not hashable.
+    def make_key(self):
+        key = (self._fn, self._args, tuple(sorted(self._kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
 class Globals(object):
     def __init__(self, config):
         self.config = config
         self.cond = threading.Condition()
+        # Heap of (deadline, sequence, Closure)
         self.triggers = []
+        self.trigger_seq = itertools.count()
+        # Coalescable closures that have not yet run
+        self.pending = {}
+        self.dispatched = 0
+        self.coalesced = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.lag = Histogram()
         self.threads = []
+        self.add_threads()
+
+    # Create the worker threads, which are started by run()
+    def add_threads(self):
+        config = self.config
         self.dbt = self.add_thread(DBThread(self))
         self.door_up = self.add_thread(DoorMonitor(self, "door_up"))
         self.door_down = self.add_thread(DoorMonitor(self, "door_down"))
@@ -1175,21 +2981,69 @@ class Globals(object):
         self.irc = self.add_thread(IRCSpammer(self))
         self.arp = self.add_thread(ARPMonitor(self))
         self.hifi = self.add_thread(HifiMonitor(self))
+        if config.has_option("arp", "netlink") \
+                and config.getboolean("arp", "netlink"):
+            self.neigh = self.add_thread(NeighMonitor(self))
+        if config.has_option("metrics", "port"):
+            self.metrics = self.add_thread(MetricsThread(self))
 
     def add_thread(self, t):
         self.threads.append(t)
         t.daemon = True
         return t
 
-    # Run a function from the main thread with no locks held after a delay
-    def schedule_delay(self, fn, delay, *args, **kwargs):
+    def _add_trigger(self, cl, coalesce):
         with self.cond:
-            self.triggers.append(Closure(fn, time.time()+delay, args, kwargs))
-            self.cond.notify()
+            if coalesce:
+                cl.key = cl.make_key()
+            if cl.key is not None:
+                old = self.pending.get(cl.key)
+                if old is not None and not old.cancelled:
+                    if old.timeout <= cl.timeout:
+                        self.coalesced += 1
+                        return old
+                    old.cancel()
+                self.pending[cl.key] = cl
+            heapq.heappush(self.triggers, (cl.timeout, next(self.trigger_seq), cl))
+            # Only need to wake the dispatcher if the deadline moved
+            if self.triggers[0][2] is cl:
+                self.cond.notify()
+        return cl
+
+    # Run a function from the main thread with no locks held after a delay.
+    # Returns a handle that can be used to cancel the call.
+    def schedule_delay(self, fn, delay, *args, **kwargs):
+        return self._add_trigger(Closure(fn, time.time()+delay, args, kwargs), False)
 
     # Run a function from the main thread with no locks held
     def schedule(self, fn, *args, **kwargs):
-        self.schedule_delay(fn, 0, *args, **kwargs)
+        return self.schedule_delay(fn, 0, *args, **kwargs)
+
+    # As schedule(), but does nothing if an identical call is already pending
+    def schedule_once(self, fn, *args, **kwargs):
+        return self._add_trigger(Closure(fn, time.time(), args, kwargs), True)
+
+    # Number of calls waiting to run (including cancelled ones not yet reaped)
+    def queue_depth(self):
+        return len(self.triggers)
+
+    def _dispatch(self, cl):
+        lag = time.time() - cl.timeout
+        self.lag.observe(lag)
+        self.dispatched += 1
+        self.total_lag += lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if lag > 1.0:
+            dbg("Dispatch of %s delayed by %.1fs" % (cl, lag))
+        try:
+            cl()
+        except KeyboardInterrupt:
+            dbg("Got kbint")
+            raise
+        except BaseException as e:
+            dbg("main(%s)" % cl)
+            traceback.print_exc()
 
     def run(self):
         # Start all the worker threads
@@ -1200,34 +3054,23 @@ class Globals(object):
             while True:
                 with self.cond:
                     now = time.time()
-                    deadline = None
-                    triggers = self.triggers
-                    self.triggers = []
                     expired = []
-                    for cl in triggers:
-                        timeout = cl.timeout
-                        if timeout > now:
-                            self.triggers.append(cl)
-                            if deadline is None or timeout < deadline:
-                                deadline = timeout
-                        else:
+                    while len(self.triggers) > 0 and self.triggers[0][0] <= now:
+                        cl = heapq.heappop(self.triggers)[2]
+                        if cl.key is not None and self.pending.get(cl.key) is cl:
+                            del self.pending[cl.key]
+                        if not cl.cancelled:
                             expired.append(cl)
                     if len(expired) == 0:
-                        if deadline is None:
+                        if len(self.triggers) == 0:
                             timeout = None
                         else:
-                            timeout = deadline - now;
-                        dbg("Waiting %s" % (str(timeout)))
-                        self.cond.wait(deadline - now)
+                            timeout = self.triggers[0][0] - now
+                        dbg("Waiting %s (%d queued)"
+                                % (str(timeout), len(self.triggers)), LOG_TRACE)
+                        self.cond.wait(timeout)
                 for cl in expired:
-                    try:
-                        cl()
-                    except KeyboardInterrupt:
-                        dbg("Got kbint")
-                        raise
-                    except BaseException as e:
-                        dbg("main(%s)")
-                        traceback.print_exc()
+                    self._dispatch(cl)
         except KeyboardInterrupt:
             dbg("Got kbint2")
             pass
@@ -1237,23 +3080,42 @@ class Globals(object):
                 t.kill()
             for t in self.threads:
                 t.join(30)
+            try:
+                self.dbt.flush_batch()
+                self.dbt.journal.sync()
+            except:
+                traceback.print_exc()
             dbg("Exiting")
 
-op = optparse.OptionParser()
-op.add_option("-d", "--debug", action="store_true", dest="debug", default=False)
-(options, args) = op.parse_args()
-do_debug = options.debug
-
-cfg = ConfigParser.SafeConfigParser()
-cfg.read("/etc/marvin.conf")
-
-dc = daemon.DaemonContext()
-dc.pidfile = PidFile('/var/run/doord.pid')
-if do_debug:
-    dc.detach_process = False
-    dc.stdout = sys.stdout
-    dc.stderr = sys.stderr
-with dc:
-    setproctitle.setproctitle("doord")
-    g = Globals(cfg)
-    g.run()
+def main():
+    global do_debug, log_level, log_writer, g
+
+    op = optparse.OptionParser()
+    op.add_option("-d", "--debug", action="store_true", dest="debug", default=False)
+    op.add_option("-l", "--log-level", type="choice", dest="log_level",
+            choices=log_levels.keys(), default="debug")
+    (options, args) = op.parse_args()
+    do_debug = options.debug
+    log_level = log_levels[options.log_level]
+
+    cfg = ConfigParser.SafeConfigParser()
+    cfg.read("/etc/marvin.conf")
+
+    dc = daemon.DaemonContext()
+    dc.pidfile = PidFile('/var/run/doord.pid')
+    if do_debug:
+        dc.detach_process = False
+        dc.stdout = sys.stdout
+        dc.stderr = sys.stderr
+    with dc:
+        setproctitle.setproctitle("doord")
+        log_writer = LogWriter(LOG_FILE)
+        log_writer.start()
+        try:
+            g = Globals(cfg)
+            g.run()
+        finally:
+            log_writer.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,741 @@
+# Python emulations of the DoorLock and Marvin firmware, for exercising
+# doord without any Arduinos attached.
+#
+# Each device is a thread talking to the master side of a pseudo-terminal.
+# doord opens the slave side as if it were a real serial port.  Unless
+# pace is False, bytes are paced at the current line rate (8N1) in both
+# directions, so round-trip times are comparable with the real hardware.
+#
+# The line rate doord sets on the slave side is visible on the master.
+# While it differs from the device's rate, everything sent in either
+# direction is lost, as it would be garbled on a real line.
+#
+# Events (tag scans, keypresses, door sensors) are injected from other
+# threads and reported to doord exactly as the firmware would.  Times the
+# firmware counts in milliseconds are given here in seconds, and can be
+# shortened so that a benchmark does not spend most of its time waiting
+# for the door to relock.
+#
+# See DoorLock.ino and Marvin.ino for the protocol details.
+
+from __future__ import print_function
+
+import errno
+import os
+import select
+import struct
+import termios
+import threading
+import time
+
+import crc16
+
+DEFAULT_BAUD = 9600
+BAUD_CONFIRM_INTERVAL = 2.0
+BAUD_RATES = {termios.B9600: 9600, termios.B19200: 19200,
+        termios.B38400: 38400, termios.B57600: 57600,
+        termios.B115200: 115200}
+
+# DoorLock.ino
+DOOR_FEATURES = "MDLBW"
+DOOR_MAX_MSG_SIZE = 128
+# Type, address and data, leaving room for the CRC
+DOOR_MAX_DATA_SIZE = DOOR_MAX_MSG_SIZE - 4
+DOOR_FRAME_SYNC = 0xFE
+DOOR_LOG_BUF_SIZE = 256
+DOOR_MAX_TAG_LEN = 20
+DOOR_PING_TIMEOUT = 90
+DOOR_PIN_INTERVAL = 10.0
+DOOR_FAIL_INTERVAL = 2.0
+# External EEPROM, as fitted to the real locks
+DOOR_EEPROM_TAG_START = 64
+DOOR_EEPROM_TAG_END = 0x7fff
+
+# Marvin.ino
+MARVIN_VERSION = "Marvin 1.6"
+MARVIN_INPUT_SIZE = 10
+
+def crc_str(s):
+    return "%04X" % crc16.crc16xmodem(s)
+
+def encode64(val):
+    if val < 26:
+        return chr(val + ord("A"))
+    val -= 26
+    if val < 26:
+        return chr(val + ord("a"))
+    val -= 26
+    if val < 10:
+        return chr(val + ord("0"))
+    val -= 10
+    if val == 0:
+        return '+'
+    if val == 1:
+        return '/'
+    return '*'
+
+def decode64(c):
+    if c >= 'A' and c <= 'Z':
+        return ord(c) - ord('A')
+    if c >= 'a' and c <= 'z':
+        return ord(c) + 26 - ord('a')
+    if c >= '0' and c <= '9':
+        return ord(c) + 52 - ord('0')
+    if c == '+':
+        return 62
+    if c == '/':
+        return 63
+    # Invalid character
+    return 0
+
+def is_hex(s):
+    for c in s:
+        if c not in "0123456789ABCDEFabcdef":
+            return False
+    return True
+
+# Common pty handling.  Subclasses implement handle_line() and poll(),
+# and may only write to the pty from the device thread.
+class SerialDevice(threading.Thread):
+    def __init__(self, fd, pace):
+        super(SerialDevice, self).__init__()
+        self.daemon = True
+        self.fd = fd
+        self.pace = pace
+        self.baud = DEFAULT_BAUD
+        self.baud_confirm = None
+        self.garbled = 0
+        self.lock = threading.Condition()
+        self.wake_r, self.wake_w = os.pipe()
+        self.rx = ""
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines_in = 0
+        self.lines_out = 0
+
+    # Time taken to send n bytes over the line
+    def line_time(self, n):
+        if not self.pace:
+            return 0
+        return n * 10.0 / self.baud
+
+    def host_baud(self):
+        return BAUD_RATES.get(termios.tcgetattr(self.fd)[5], 0)
+
+    # Switch rate after the current response has gone out.  Other than
+    # to DEFAULT_BAUD, the change must be confirmed by the host.
+    def set_baud(self, baud):
+        self.baud = baud
+        if baud == DEFAULT_BAUD:
+            self.baud_confirm = None
+        else:
+            self.baud_confirm = time.time() + BAUD_CONFIRM_INTERVAL
+
+    def write(self, data):
+        time.sleep(self.line_time(len(data)))
+        if self.host_baud() != self.baud:
+            self.garbled += len(data)
+            return
+        os.write(self.fd, data)
+        self.bytes_out += len(data)
+        self.lines_out += 1
+
+    # Called with the lock held from other threads
+    def wakeup(self):
+        os.write(self.wake_w, "x")
+
+    # Seconds until poll() next needs to run, or None
+    def next_timeout(self):
+        return None
+
+    def poll(self):
+        pass
+
+    # Returns (frame, length) for the first complete frame in rx, or None.
+    # length includes the terminator.
+    def next_frame(self):
+        i = -1
+        for c in "\r\n":
+            j = self.rx.find(c)
+            if j >= 0 and (i < 0 or j < i):
+                i = j
+        if i < 0:
+            return None
+        return (self.rx[:i], i + 1)
+
+    def read_lines(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as e:
+            # Nobody has the slave side open
+            if e.errno != errno.EIO:
+                raise
+            time.sleep(0.1)
+            return
+        if self.host_baud() != self.baud:
+            self.garbled += len(data)
+            return
+        self.bytes_in += len(data)
+        self.rx += data
+        while True:
+            f = self.next_frame()
+            if f is None:
+                break
+            (line, n) = f
+            self.rx = self.rx[n:]
+            self.lines_in += 1
+            # The last byte arrives one line time after the first
+            time.sleep(self.line_time(n))
+            with self.lock:
+                self.handle_line(line)
+
+    def run(self):
+        while True:
+            with self.lock:
+                timeout = self.next_timeout()
+                if self.baud_confirm is not None:
+                    if self.baud_confirm <= time.time():
+                        self.set_baud(DEFAULT_BAUD)
+                    elif timeout is None:
+                        timeout = self.baud_confirm - time.time()
+                    else:
+                        timeout = min(timeout, self.baud_confirm - time.time())
+            if timeout is not None:
+                timeout = max(timeout, 0)
+            ready = select.select([self.fd, self.wake_r], [], [], timeout)[0]
+            if self.wake_r in ready:
+                os.read(self.wake_r, 4096)
+            if self.fd in ready:
+                self.read_lines()
+            with self.lock:
+                self.poll()
+
+# DoorLock.ino.  Only the single device case is handled properly: frames
+# for other addresses are passed back to the host, as the last device in
+# a ring would.
+class DoorLockSim(SerialDevice):
+    def __init__(self, fd, pace=True, unlock_period=10.0, green_period=None,
+            features=DOOR_FEATURES):
+        super(DoorLockSim, self).__init__(fd, pace)
+        self.unlock_period = unlock_period
+        # The reader is not scanning while the LED is green
+        if green_period is None:
+            green_period = max(unlock_period, 5.0)
+        self.green_period = green_period
+        self.features = features
+        self.addr = '?'
+        self.binary = False
+        # Ring buffer, as the firmware keeps it
+        self.log_buf = bytearray(DOOR_LOG_BUF_SIZE)
+        self.log_head = 0
+        self.log_tail = 0
+        self.log_ack_tail = 0
+        self.clock = 0
+        self.clock_set = time.time()
+        self.ping_deadline = 0
+        # [tag, pin, deleted] in EEPROM order
+        self.tags = []
+        self.eeprom_last = DOOR_EEPROM_TAG_START
+        self.last_tag = ""
+        self.pin = None
+        self.pin_pos = 0
+        self.pin_valid = False
+        self.pin_timeout = None
+        self.fail_timeout = None
+        self.relock_time = None
+        self.green_time = None
+        self.door_open = False
+        self.seen_event = False
+        self.seen_kp = []
+        # (time, tag) for each unlock
+        self.unlocks = []
+        self.log_overruns = 0
+        self.crc_errors = 0
+        self.commands = {}
+
+    def is_alive(self):
+        return time.time() < self.ping_deadline
+
+    def current_time(self):
+        return self.clock + int(time.time() - self.clock_set)
+
+    def log_push(self, c):
+        self.log_buf[self.log_head] = c
+        self.log_head = (self.log_head + 1) & (DOOR_LOG_BUF_SIZE - 1)
+        # The firmware does not check for this either
+        if self.log_head == self.log_ack_tail:
+            self.log_overruns += 1
+
+    def log_pop(self):
+        c = self.log_buf[self.log_tail]
+        self.log_tail = (self.log_tail + 1) & (DOOR_LOG_BUF_SIZE - 1)
+        return c
+
+    def log_entry(self, action, tag=""):
+        t = self.current_time()
+        for i in xrange(0, 6):
+            self.log_push(ord(encode64(t & 0x3f)))
+            t >>= 6
+        self.log_push(ord(action))
+        for c in tag:
+            self.log_push(ord(c))
+        self.log_push(0)
+        self.seen_event = True
+
+    def send_packet(self, msg):
+        if self.binary:
+            self.write(struct.pack(">BB", DOOR_FRAME_SYNC, len(msg)) + msg
+                    + struct.pack(">H", crc16.crc16xmodem(msg)))
+        else:
+            self.write(msg + crc_str(msg) + "\n")
+
+    def send_ack(self):
+        self.send_packet("A" + self.addr)
+
+    def comment(self, msg):
+        if not self.binary:
+            self.write("# %s\r\n" % msg)
+
+    def tag_hash(self):
+        crc = 0
+        for (tag, pin, deleted) in self.tags:
+            if not deleted:
+                crc = crc16.crc16xmodem(tag + ' ' + pin + chr(0), crc)
+        return crc
+
+    def find_tag(self, tag):
+        for (t, pin, deleted) in self.tags:
+            if t == tag and not deleted:
+                return pin
+        return None
+
+    # Returns an error string, or None
+    def add_tag(self, key):
+        if len(key) < 13:
+            return "tag too short"
+        if self.eeprom_last + len(key) - 4 >= DOOR_EEPROM_TAG_END:
+            return "#tag list full"
+        if not is_hex(key[:8]):
+            return "Bad tag"
+        if key[8] != ' ':
+            return "Tag too long"
+        self.tags.append([key[:8].upper(), key[9:], False])
+        self.eeprom_last += len(key) - 4
+        return None
+
+    def delete_tag(self, tag):
+        if len(tag) != 8:
+            return None
+        for t in self.tags:
+            if t[0] == tag:
+                t[2] = True
+        return None
+
+    def reset_keys(self):
+        self.tags = []
+        self.eeprom_last = DOOR_EEPROM_TAG_START
+
+    def send_log(self, bulk):
+        msg = "V" + self.addr
+        self.log_tail = self.log_ack_tail
+        while self.log_head != self.log_tail:
+            rec_tail = self.log_tail
+            rec = ""
+            while self.log_head != self.log_tail:
+                c = self.log_pop()
+                if c == 0:
+                    break
+                rec += chr(c)
+            if self.binary:
+                t = 0
+                for i in xrange(0, 6):
+                    t |= decode64(rec[i]) << (i * 6)
+                rec = struct.pack("<I", t) + rec[6:]
+            if bulk and self.binary:
+                rec = chr(len(rec)) + rec
+            elif bulk and len(msg) > 2:
+                rec = "," + rec
+            if len(msg) + len(rec) > DOOR_MAX_DATA_SIZE:
+                self.log_tail = rec_tail
+                break
+            msg += rec
+            if not bulk:
+                break
+        self.send_packet(msg)
+
+    # Apply a comma separated list of keys, stopping at the first error
+    def key_list(self, data, fn):
+        if data == "":
+            self.send_ack()
+            return
+        for key in data.split(","):
+            err = fn(key)
+            if err is not None:
+                self.comment(err)
+                return
+        self.send_ack()
+
+    def unlock_door(self):
+        was_locked = self.relock_time is None
+        self.relock_time = time.time() + self.unlock_period
+        self.green_time = time.time() + self.green_period
+        if not was_locked:
+            return
+        self.log_entry('U', self.last_tag)
+        self.unlocks.append((time.time(), self.last_tag))
+        self.lock.notify_all()
+
+    def process_msg(self, msg):
+        cmd = msg[0]
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        if cmd == 'S':
+            self.addr = msg[1]
+            msg = msg[0] + chr(ord(msg[1]) + 1) + msg[2:]
+        elif cmd == 'P':
+            if msg[1] != self.addr:
+                msg = msg[0] + '!' + msg[2:]
+            else:
+                msg = msg[0] + chr(ord(msg[1]) + 1) + msg[2:]
+                if self.binary and len(msg) == 6:
+                    self.clock = struct.unpack("<I", msg[2:])[0]
+                    self.clock_set = time.time()
+                elif not self.binary and len(msg) == 8:
+                    t = 0
+                    for i in xrange(0, 6):
+                        t |= decode64(msg[2 + i]) << (i * 6)
+                    self.clock = t
+                    self.clock_set = time.time()
+                self.ping_deadline = time.time() + DOOR_PING_TIMEOUT
+                self.baud_confirm = None
+        elif cmd != '#' and (cmd not in self.features + "CGRNFKUZ"
+                or msg[1] != self.addr):
+            # Not for us, or not understood
+            pass
+        elif cmd == 'B':
+            if msg[2:].isdigit() and int(msg[2:]) in BAUD_RATES.values():
+                self.send_ack()
+                self.set_baud(int(msg[2:]))
+                return
+        elif cmd == 'W':
+            if msg[2:] in ("A", "B"):
+                self.send_ack()
+                self.binary = msg[2] == 'B'
+                return
+        elif cmd == 'C':
+            if len(msg) == 2:
+                self.log_ack_tail = self.log_tail
+                self.send_ack()
+            return
+        elif cmd == 'G' or cmd == 'L':
+            if len(msg) == 2:
+                self.send_log(cmd == 'L')
+                return
+        elif cmd == 'R':
+            if len(msg) == 2:
+                self.reset_keys()
+                self.send_ack()
+            return
+        elif cmd == 'N':
+            if len(msg) >= 4:
+                err = self.add_tag(msg[2:])
+                if err is None:
+                    self.send_ack()
+                else:
+                    self.comment(err)
+            return
+        elif cmd == 'M':
+            self.key_list(msg[2:], self.add_tag)
+            return
+        elif cmd == 'D':
+            self.key_list(msg[2:], self.delete_tag)
+            return
+        elif cmd == 'F':
+            if len(msg) == 2:
+                self.send_packet("F" + self.addr + self.features)
+            return
+        elif cmd == 'K':
+            if len(msg) == 2:
+                if self.binary:
+                    self.send_packet("H" + self.addr
+                            + struct.pack(">H", self.tag_hash()))
+                else:
+                    self.comment("%d bytes EEPROM free"
+                            % (DOOR_EEPROM_TAG_END - self.eeprom_last))
+                    self.send_packet("H%s%04X" % (self.addr, self.tag_hash()))
+            return
+        elif cmd == 'U':
+            self.pin = None
+            self.pin_valid = False
+            self.pin_timeout = None
+            self.fail_timeout = None
+            self.last_tag = "REMOTE"
+            self.unlock_door()
+            self.send_ack()
+            return
+        elif cmd == 'Z':
+            self.send_ack()
+            return
+        self.send_packet(msg)
+
+    # In binary mode, frames are returned without the sync and length
+    # bytes.  "X\n" between frames goes back to ASCII framing.
+    def next_frame(self):
+        if not self.binary:
+            return super(DoorLockSim, self).next_frame()
+        while len(self.rx) > 0 and ord(self.rx[0]) != DOOR_FRAME_SYNC:
+            if self.rx == "X":
+                return None
+            if self.rx.startswith("X\n"):
+                self.binary = False
+                self.rx = self.rx[2:]
+                return super(DoorLockSim, self).next_frame()
+            self.rx = self.rx[1:]
+        if len(self.rx) < 2:
+            return None
+        n = ord(self.rx[1])
+        if n < 2 or n > DOOR_MAX_MSG_SIZE - 2:
+            self.rx = self.rx[1:]
+            return self.next_frame()
+        if len(self.rx) < n + 4:
+            return None
+        return (self.rx[2:n + 4], n + 4)
+
+    def handle_line(self, line):
+        if self.binary:
+            msg = line[:-2]
+            if struct.unpack(">H", line[-2:])[0] != crc16.crc16xmodem(msg):
+                self.crc_errors += 1
+                return
+            self.process_msg(msg)
+            return
+        if len(line) < 6 or len(line) > DOOR_MAX_MSG_SIZE:
+            return
+        msg = line[:-4]
+        if line[-4:] != crc_str(msg):
+            self.crc_errors += 1
+            return
+        self.process_msg(msg)
+
+    def next_timeout(self):
+        if self.seen_event or len(self.seen_kp) > 0:
+            return 0
+        deadlines = [t for t in (self.pin_timeout, self.fail_timeout,
+            self.relock_time, self.green_time) if t is not None]
+        if len(deadlines) == 0:
+            return None
+        return min(deadlines) - time.time()
+
+    def poll(self):
+        now = time.time()
+        if self.baud != DEFAULT_BAUD and not self.is_alive():
+            self.set_baud(DEFAULT_BAUD)
+        if self.binary and not self.is_alive():
+            self.binary = False
+        if self.relock_time is not None and self.relock_time <= now:
+            self.relock_time = None
+            self.last_tag = ""
+            self.lock.notify_all()
+        if self.green_time is not None and self.green_time <= now:
+            self.green_time = None
+            self.lock.notify_all()
+        if self.pin_timeout is not None and self.pin_timeout <= now:
+            self.log_entry('P', self.last_tag)
+            self.pin_timeout = None
+            self.pin = None
+            self.pin_valid = False
+            self.fail_timeout = now + DOOR_FAIL_INTERVAL
+        if self.fail_timeout is not None and self.fail_timeout <= now:
+            self.fail_timeout = None
+        if self.pin is not None and self.pin_pos == len(self.pin) \
+                and self.pin_valid:
+            self.pin = None
+            self.pin_valid = False
+            self.pin_timeout = None
+            self.unlock_door()
+        if self.seen_event:
+            self.send_packet("E" + self.addr)
+            self.seen_event = False
+        for c in self.seen_kp:
+            self.send_packet("Y" + self.addr + c)
+        self.seen_kp = []
+
+    # The remaining methods are called from other threads
+
+    # Present a tag to the reader.  Returns False if the reader is not
+    # scanning because the door is unlocked.
+    def scan(self, tag):
+        with self.lock:
+            if self.relock_time is not None or self.green_time is not None:
+                return False
+            pin = self.find_tag(tag)
+            if pin is None:
+                self.fail_timeout = time.time() + DOOR_FAIL_INTERVAL
+                self.pin = None
+                self.pin_valid = False
+                self.pin_timeout = None
+                if self.is_alive() or self.last_tag != tag:
+                    self.last_tag = tag
+                    self.log_entry('R', tag)
+            else:
+                self.fail_timeout = None
+                self.pin_timeout = time.time() + DOOR_PIN_INTERVAL
+                if self.pin is not None and self.last_tag == tag \
+                        and self.pin_valid:
+                    return True
+                self.last_tag = tag
+                self.pin = pin
+                self.pin_pos = 0
+                self.pin_valid = True
+                if self.is_alive():
+                    self.log_entry('Q', tag)
+            self.wakeup()
+        return True
+
+    def keypress(self, c):
+        with self.lock:
+            if self.pin is not None:
+                if self.pin_pos < len(self.pin) and c == self.pin[self.pin_pos]:
+                    self.pin_pos += 1
+                else:
+                    self.pin_valid = False
+                self.pin_timeout = time.time() + DOOR_PIN_INTERVAL
+            else:
+                self.seen_kp.append(c)
+            self.wakeup()
+
+    def set_door(self, is_open):
+        with self.lock:
+            if self.door_open != is_open:
+                self.door_open = is_open
+                if is_open:
+                    self.log_entry('O')
+                else:
+                    self.log_entry('C')
+                self.wakeup()
+
+    def button(self):
+        with self.lock:
+            self.log_entry('B')
+            self.wakeup()
+
+    # Wait for the number of unlocks to exceed n.  Returns the time of
+    # that unlock, or None on timeout.
+    def wait_unlock(self, n, timeout):
+        end = time.time() + timeout
+        with self.lock:
+            while len(self.unlocks) <= n:
+                left = end - time.time()
+                if left <= 0:
+                    return None
+                self.lock.wait(left)
+            return self.unlocks[n][0]
+
+    # Wait until the reader is scanning again
+    def wait_relock(self, timeout):
+        end = time.time() + timeout
+        with self.lock:
+            while self.relock_time is not None or self.green_time is not None:
+                left = end - time.time()
+                if left <= 0:
+                    return False
+                self.lock.wait(left)
+        return True
+
+# Marvin.ino
+class MarvinSim(SerialDevice):
+    def __init__(self, fd, pace=True, temperature=21, version=MARVIN_VERSION):
+        super(MarvinSim, self).__init__(fd, pace)
+        self.temperature = temperature
+        self.version = version
+        self.seen_ping = False
+        self.sign = False
+        self.pan_angle = 90
+        self.bell_timer = None
+        # (time, seconds) for each bell command
+        self.bells = []
+        self.queries = 0
+        self.commands = {}
+
+    def println(self, s):
+        self.write(s + "\r\n")
+
+    def handle_line(self, line):
+        # The firmware only keeps the first 9 characters
+        line = line[:MARVIN_INPUT_SIZE - 1]
+        if line == "":
+            return
+        cmd = line[0]
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        if cmd == 'W':
+            if len(line) == 1:
+                self.println("ANGLE=%d" % self.pan_angle)
+            else:
+                self.pan_angle = atoi(line[1:])
+                self.println("OK")
+        elif cmd == 'T':
+            self.println("TEMP=%d" % self.temperature)
+        elif cmd == 'P':
+            self.println("PIR=0")
+        elif cmd == 'D':
+            self.println("DOORS=0,0,0")
+        elif cmd == 'S':
+            self.sign = line[1:2] == '1'
+            self.println("OK")
+        elif cmd == 'B':
+            seconds = atoi(line[1:])
+            self.bell_timer = time.time() + seconds
+            self.bells.append((time.time(), seconds))
+            self.lock.notify_all()
+            self.println("OK")
+        elif cmd == 'R' and self.version != "Marvin 1.5":
+            baud = atoi(line[1:])
+            if baud in BAUD_RATES.values():
+                self.println("OK")
+                self.set_baud(baud)
+            else:
+                self.println("ERR")
+        elif cmd == '?':
+            if len(line) == 1:
+                self.queries += 1
+                self.baud_confirm = None
+                if self.seen_ping:
+                    self.println(self.version)
+                else:
+                    self.seen_ping = True
+                    self.println(self.version + "+")
+
+    def next_timeout(self):
+        if self.bell_timer is None:
+            return None
+        return self.bell_timer - time.time()
+
+    def poll(self):
+        if self.bell_timer is not None and self.bell_timer <= time.time():
+            self.bell_timer = None
+
+    # Called from other threads.  Wait for the number of bell commands to
+    # exceed n, returning the time of that command or None on timeout.
+    def wait_bell(self, n, timeout):
+        end = time.time() + timeout
+        with self.lock:
+            while len(self.bells) <= n:
+                left = end - time.time()
+                if left <= 0:
+                    return None
+                self.lock.wait(left)
+            return self.bells[n][0]
+
+# As the C library function: leading digits, 0 if none
+def atoi(s):
+    n = 0
+    neg = False
+    if s[:1] == '-':
+        neg = True
+        s = s[1:]
+    for c in s:
+        if c < '0' or c > '9':
+            break
+        n = n * 10 + ord(c) - ord('0')
+    if neg:
+        return -n
+    return n
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Compare the ASCII and binary door lock framings: bytes on the wire for
+# typical messages, and the time DoorMonitor takes to parse them.
+#
+# The device side of each message is encoded with doord's own codecs (the
+# frame format is the same in both directions).  Parsing goes through
+# DoorMonitor.next_frame() on a filled receive buffer, then the log
+# records are split and decoded as drain_log() does, so the figures cover
+# doord's parsing alone, without the serial port or the database.
+#
+# Run from the top of the repository, on a machine with doord's
+# dependencies installed:
+#   python sim/framebench.py [--count 2000] [--records 7]
+
+from __future__ import print_function
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import doord
+
+T0 = 1500000000
+
+# (name, message) pairs sent by the device, as seen in a tag scan:
+# notification, ping reply, log drain, acknowledgements, key hash
+def device_messages(codec, records):
+    recs = []
+    for i in range(records):
+        recs.append(codec.encode_time(T0 + i) + "U" + "%08X" % (0xA0000000 + i))
+    if codec is doord.BINARY_CODEC:
+        log = "".join(chr(len(r)) + r for r in recs)
+    else:
+        log = ",".join(recs)
+    return [("event", "E0"),
+            ("ping", "P1" + codec.encode_time(T0)),
+            ("log", "V0" + log),
+            ("ack", "A0"),
+            ("keypad", "Y0#"),
+            ("hash", "H0" + codec.encode_hash(0x1234))]
+
+# Returns the number of responses and log records parsed.  Notifications
+# are handled inside next_frame().
+def parse_all(door, codec, stream):
+    door.codec = codec
+    door.rx_buf = bytearray(stream)
+    door.rx_pos = 0
+    responses = 0
+    records = 0
+    while True:
+        r = door.next_frame()
+        if r is None:
+            break
+        responses += 1
+        if r[0] == 'V':
+            for rec in codec.split_log(r[2:], True):
+                if codec.decode_log(rec) is None:
+                    raise Exception("Bad log record")
+                records += 1
+    return (responses, records)
+
+def main():
+    op = optparse.OptionParser()
+    op.add_option("--count", type="int", dest="count", default=2000,
+            help="times to repeat the message sequence")
+    op.add_option("--records", type="int", dest="records", default=7,
+            help="log records in each bulk log reply")
+    (options, args) = op.parse_args()
+
+    door = doord.DoorMonitor(None, "bench")
+    for codec in (doord.ASCII_CODEC, doord.BINARY_CODEC):
+        msgs = device_messages(codec, options.records)
+        sizes = ", ".join("%s %d" % (name, len(codec.encode(m)))
+                for (name, m) in msgs)
+        for (name, m) in msgs:
+            if len(m) > doord.DOOR_MAX_FRAME - 4:
+                raise Exception("%s message too long, use fewer --records"
+                        % name)
+        stream = "".join(codec.encode(m) for (name, m) in msgs) * options.count
+        t = time.time()
+        (responses, records) = parse_all(door, codec, stream)
+        elapsed = time.time() - t
+        frames = len(msgs) * options.count
+        print("%s: bytes %s; %d bytes in %d frames (%d responses, %d log"
+                " records) parsed in %.3fs, %.1fus/frame"
+                % (codec.name, sizes, len(stream), frames, responses, records,
+                    elapsed, elapsed * 1e6 / frames))
+
+if __name__ == "__main__":
+    main()
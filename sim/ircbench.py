@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Measure IRCSpammer delivery latency against a local fake bot.
+#
+# The fake bot listens on localhost, accepts any number of connections
+# and records when each line arrives.  A burst of --count messages is
+# sent, then a keyed message is flapped --flaps times to show coalescing.
+#
+# Run from the top of the repository, on a machine with doord's
+# dependencies installed:
+#   python sim/ircbench.py [--count 20] [--flaps 6]
+
+from __future__ import print_function
+
+import optparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import doord
+
+class FakeBot(threading.Thread):
+    def __init__(self):
+        super(FakeBot, self).__init__()
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.lock = threading.Lock()
+        # (time, line)
+        self.lines = []
+        self.connections = 0
+
+    def serve(self, conn):
+        buf = ""
+        while True:
+            data = conn.recv(4096)
+            if data == "":
+                break
+            buf += data
+            while "\n" in buf:
+                line, buf = buf.split("\n", 1)
+                with self.lock:
+                    self.lines.append((time.time(), line))
+        conn.close()
+
+    def run(self):
+        while True:
+            conn, addr = self.sock.accept()
+            with self.lock:
+                self.connections += 1
+            t = threading.Thread(target=self.serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+class Config(object):
+    def __init__(self, port):
+        self.values = {"msghost": "127.0.0.1", "msgport": str(port),
+                "msgchannel": "#test"}
+    def get(self, section, option):
+        return self.values[option]
+
+class Globals(object):
+    def __init__(self, config):
+        self.config = config
+
+def wait_lines(bot, n, timeout):
+    end = time.time() + timeout
+    while time.time() < end:
+        with bot.lock:
+            if len(bot.lines) >= n:
+                return
+        time.sleep(0.01)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def main():
+    op = optparse.OptionParser()
+    op.add_option("--count", type="int", dest="count", default=20)
+    op.add_option("--flaps", type="int", dest="flaps", default=6)
+    (options, args) = op.parse_args()
+
+    bot = FakeBot()
+    bot.start()
+    irc = doord.IRCSpammer(Globals(Config(bot.port)))
+    irc.daemon = True
+    irc.start()
+
+    sent = {}
+    for i in range(options.count):
+        msg = "burst %d" % i
+        sent["#test " + msg] = time.time()
+        irc.send(msg)
+    wait_lines(bot, options.count, options.count / doord.IRC_RATE + 10)
+    with bot.lock:
+        lat = [t - sent[l] for (t, l) in bot.lines if l in sent]
+    print("burst: %d/%d delivered, latency p50 %.1fms p90 %.1fms max %.1fms,"
+            " %d connections" % (len(lat), options.count,
+                percentile(lat, 50) * 1000, percentile(lat, 90) * 1000,
+                max(lat) * 1000, bot.connections))
+
+    with bot.lock:
+        before = len(bot.lines)
+    for i in range(options.flaps):
+        irc.send("Internal door %s" % ["open", "closed"][i % 2], "internaldoor")
+    time.sleep(doord.IRC_COALESCE_WINDOW + 1)
+    with bot.lock:
+        flapped = [l for (t, l) in bot.lines[before:]]
+    print("flap: %d keyed messages, %d delivered %s"
+            % (options.flaps, len(flapped), flapped))
+    irc.kill()
+    irc.join(5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# End-to-end load and latency benchmark for the door and aux threads,
+# using the firmware emulations in devices.py.
+#
+# doord's DoorMonitor and AuxMonitor threads run unmodified in this
+# process, attached to the emulated devices over pseudo-terminals, with
+# FakeDB standing in for the database thread.  The devices and the code
+# driving them run in a forked child, so the CPU time reported is doord's
+# alone.  Reported:
+#
+#   resync: time from set_keys() until the door is back in sync, for a
+#           complete change of key list and for one added key
+#   scan:   tag scan to unlock, for tags the lock does not know but
+#           query_override() lets in, on both doors at once
+#   otp:    last keypad digit of a one-time code to unlock
+#   bell:   '#' on the keypad to the bell command reaching Marvin
+#   rtt:    mean command round trip per port, per batch of commands
+#           for Marvin
+#
+# All three ports negotiate --fast-baud, if given, as configured in the
+# [serial] section of marvin.conf.  With --binary the doors also switch
+# to binary framing, as configured in the [framing] section.
+# The emulated locks relock, and scan again, after --unlock-period rather
+# than 10s.
+#
+# Run from the top of the repository, on a machine with doord's
+# dependencies installed:
+#   python sim/loadbench.py [--scans 1000] [--keys 10,100,500,1000]
+#       [--fast-baud 57600] [--binary]
+
+from __future__ import print_function
+
+import ConfigParser
+import json
+import optparse
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import doord
+import devices
+
+OTP_CODE = "4321"
+EVENT_TIMEOUT = 10
+MEMBER_BASE = 0xA0000000
+
+# Stands in for DBThread.  Tags in members are let in by query_override(),
+# as are keypad entries ending in the one-time code.
+class FakeDB(object):
+    def __init__(self, members):
+        self.members = set(members)
+        self.overrides = 0
+        self.logged = 0
+        self.temps = []
+
+    def query_override(self, tag, match=""):
+        self.overrides += 1
+        if tag[:1] == '!':
+            return tag.endswith(OTP_CODE)
+        return tag in self.members
+
+    def log(self, t, msg):
+        self.logged += 1
+
+    def do_tag_in(self, tag):
+        pass
+
+    def do_tag_out(self, tag):
+        pass
+
+    def set_door_state(self, door_name, state):
+        pass
+
+    def seen_star(self, door_name):
+        pass
+
+    def record_temp(self, temp):
+        self.temps.append(temp)
+
+    def flush_batch(self):
+        pass
+
+# The dispatcher from doord.Globals with only the door and aux threads
+class SimGlobals(doord.Globals):
+    def __init__(self, config, door_up, door_down, aux, members):
+        self.ports = (door_up, door_down, aux)
+        self.members = members
+        super(SimGlobals, self).__init__(config)
+
+    def add_threads(self):
+        self.dbt = FakeDB(self.members)
+        self.door_up = self.add_thread(doord.DoorMonitor(self, self.ports[0]))
+        self.door_down = self.add_thread(doord.DoorMonitor(self, self.ports[1]))
+        self.aux = self.add_thread(doord.AuxMonitor(self, self.ports[2]))
+
+def make_keys(n, base):
+    return ["%08X %04d" % (base + i, i % 10000) for i in range(n)]
+
+def percentiles(values):
+    if len(values) == 0:
+        return "no samples"
+    values = sorted(values)
+    s = []
+    for p in (50, 90, 99):
+        v = values[min(len(values) - 1, int(len(values) * p / 100.0))]
+        s.append("p%d %.1fms" % (p, v * 1000))
+    s.append("max %.1fms" % (values[-1] * 1000))
+    return ", ".join(s)
+
+def cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+# Device side, run in the child process
+
+def drive_scans(door, tags, result):
+    for tag in tags:
+        door.wait_relock(EVENT_TIMEOUT)
+        n = len(door.unlocks)
+        t = time.time()
+        if not door.scan(tag):
+            result["missed"] += 1
+            continue
+        u = door.wait_unlock(n, EVENT_TIMEOUT)
+        if u is None:
+            result["missed"] += 1
+        else:
+            result["latency"].append(u - t)
+
+def drive_otp(door, count, result):
+    for i in range(count):
+        door.wait_relock(EVENT_TIMEOUT)
+        n = len(door.unlocks)
+        for c in OTP_CODE:
+            t = time.time()
+            door.keypress(c)
+        u = door.wait_unlock(n, EVENT_TIMEOUT)
+        if u is None:
+            result["missed"] += 1
+        else:
+            result["latency"].append(u - t)
+
+def drive_bell(door, marvin, count, result):
+    for i in range(count):
+        n = len(marvin.bells)
+        t = time.time()
+        door.keypress('#')
+        b = marvin.wait_bell(n, EVENT_TIMEOUT)
+        if b is None:
+            result["missed"] += 1
+        else:
+            result["latency"].append(b - t)
+
+# Run fn once for each door at the same time, merging the results
+def both_doors(doors, fn, *args):
+    result = {"latency": [], "missed": 0}
+    threads = []
+    for (i, door) in enumerate(doors):
+        t = threading.Thread(target=fn,
+                args=(door,) + tuple(a[i] for a in args) + (result,))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return result
+
+def wait_ready(doors, marvin, timeout):
+    end = time.time() + timeout
+    while time.time() < end:
+        if marvin.queries > 0 and all(d.is_alive() for d in doors):
+            return True
+        time.sleep(0.01)
+    return False
+
+def device_stats(doors, marvin):
+    stats = {"to_devices": marvin.bytes_in, "from_devices": marvin.bytes_out,
+            "log_overruns": 0, "crc_errors": 0, "garbled": marvin.garbled}
+    for d in doors:
+        stats["to_devices"] += d.bytes_in
+        stats["from_devices"] += d.bytes_out
+        stats["log_overruns"] += d.log_overruns
+        stats["crc_errors"] += d.crc_errors
+        stats["garbled"] += d.garbled
+    return stats
+
+def device_main(sock, fds, options):
+    doors = [devices.DoorLockSim(fd, options.pace, options.unlock_period,
+        options.unlock_period) for fd in fds[:2]]
+    marvin = devices.MarvinSim(fds[2], options.pace)
+    for d in doors + [marvin]:
+        d.start()
+    f = sock.makefile("r+")
+    while True:
+        l = f.readline()
+        if l == "":
+            break
+        req = json.loads(l)
+        op = req["op"]
+        if op == "ready":
+            r = wait_ready(doors, marvin, req["timeout"])
+        elif op == "scan":
+            r = both_doors(doors, drive_scans, req["tags"])
+        elif op == "otp":
+            r = both_doors(doors, drive_otp, [req["count"]] * 2)
+        elif op == "bell":
+            r = {"latency": [], "missed": 0}
+            drive_bell(doors[0], marvin, req["count"], r)
+        elif op == "button":
+            for d in doors:
+                d.button()
+            r = None
+        elif op == "stats":
+            r = device_stats(doors, marvin)
+        else:
+            r = None
+        f.write(json.dumps(r) + "\n")
+        f.flush()
+        if op == "quit":
+            break
+
+def fork_devices(fds, options):
+    (parent, child) = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            parent.close()
+            device_main(child, fds, options)
+        finally:
+            os._exit(0)
+    child.close()
+    return (pid, parent.makefile("r+"))
+
+def request(ctl, op, **kwargs):
+    kwargs["op"] = op
+    ctl.write(json.dumps(kwargs) + "\n")
+    ctl.flush()
+    return json.loads(ctl.readline())
+
+# doord side
+
+def resync(door, keys):
+    n = door.resyncs
+    t = time.time()
+    door.set_keys(keys)
+    end = t + 60
+    while door.resyncs == n or not door.sync:
+        if time.time() > end:
+            return None
+        time.sleep(0.001)
+    return time.time() - t
+
+def run_resync(door, counts):
+    base = 0x10000000
+    for n in counts:
+        base += 0x01000000
+        keys = make_keys(n, base)
+        full = resync(door, keys)
+        one = resync(door, keys + make_keys(1, base + n))
+        if full is None or one is None:
+            print("resync: %5d keys: timed out" % n)
+            continue
+        print("resync: %5d keys: full change %.2fs, one added %.3fs"
+                % (n, full, one))
+
+def report(name, r, events):
+    print("%s: %d/%d, %s" % (name, len(r["latency"]), events,
+        percentiles(r["latency"])))
+
+def main():
+    op = optparse.OptionParser()
+    op.add_option("--scans", type="int", dest="scans", default=1000,
+            help="tag scans, split between the two doors")
+    op.add_option("--otp", type="int", dest="otp", default=100,
+            help="one-time codes entered on each door")
+    op.add_option("--bells", type="int", dest="bells", default=20,
+            help="bell presses on the upstairs door")
+    op.add_option("--keys", dest="keys", default="10,100,500,1000",
+            help="key list sizes to resync")
+    op.add_option("--fast-baud", type="int", dest="fast_baud", default=0,
+            help="line rate to negotiate after the handshake")
+    op.add_option("--binary", action="store_true", dest="binary",
+            default=False, help="use binary framing on the doors")
+    op.add_option("--no-pace", action="store_false", dest="pace",
+            default=True, help="do not pace traffic at the line rate")
+    op.add_option("--unlock-period", type="float", dest="unlock_period",
+            default=0.05)
+    op.add_option("-d", "--debug", action="store_true", dest="debug",
+            default=False)
+    (options, args) = op.parse_args()
+    doord.do_debug = options.debug
+
+    masters = []
+    names = []
+    slaves = []
+    for i in range(3):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        masters.append(master)
+        slaves.append(slave)
+        names.append(os.ttyname(slave)[len("/dev/"):])
+    # The child keeps the slaves open so the devices never see EIO
+    (pid, ctl) = fork_devices(masters, options)
+    for fd in masters + slaves:
+        os.close(fd)
+
+    config = ConfigParser.SafeConfigParser()
+    config.add_section("serial")
+    if options.fast_baud:
+        for name in names:
+            config.set("serial", name, str(options.fast_baud))
+    config.add_section("framing")
+    if options.binary:
+        for name in names[:2]:
+            config.set("framing", name, "binary")
+    members = ["%08X" % (MEMBER_BASE + i) for i in range(options.scans)]
+    g = SimGlobals(config, names[0], names[1], names[2], members)
+    doord.g = g
+    for door in (g.door_up, g.door_down):
+        door.set_keys(make_keys(10, 0x10000000))
+    t = threading.Thread(target=g.run)
+    t.daemon = True
+    t.start()
+    if not request(ctl, "ready", timeout=30):
+        print("Devices did not come up")
+        sys.exit(1)
+    while not (g.door_up.sync and g.door_down.sync):
+        time.sleep(0.01)
+
+    run_resync(g.door_up, [int(n) for n in options.keys.split(",")])
+
+    # DoorMonitor ignores events logged before it first drains the log
+    # after a resync, so get that out of the way
+    request(ctl, "button")
+    while g.door_up.flush_backlog or g.door_down.flush_backlog:
+        time.sleep(0.01)
+
+    events = 0
+    before = request(ctl, "stats")
+    t0 = time.time()
+    c0 = cpu_time()
+    half = (options.scans + 1) / 2
+    r = request(ctl, "scan", tags=[members[:half], members[half:]])
+    report("scan", r, options.scans)
+    events += options.scans
+    r = request(ctl, "otp", count=options.otp)
+    report("otp", r, 2 * options.otp)
+    events += 2 * options.otp
+    r = request(ctl, "bell", count=options.bells)
+    report("bell", r, options.bells)
+    events += options.bells
+    elapsed = time.time() - t0
+    cpu = cpu_time() - c0
+    after = request(ctl, "stats")
+    print("load: %d events in %.1fs, %.2fms CPU/event, %.0f bytes/event"
+            " on the wire" % (events, elapsed, cpu * 1000 / events,
+                float(after["to_devices"] + after["from_devices"]
+                    - before["to_devices"] - before["from_devices"]) / events))
+    for port in (g.door_up, g.door_down, g.aux):
+        (buckets, n, total) = port.cmd_rtt.snapshot()
+        print("rtt: %s at %d baud: %d commands, mean %.1fms"
+                % (port.port_name, port.baud, n, total * 1000 / max(n, 1)))
+    print("aux: %d commands in %d batches" % (g.aux.commands, g.aux.batches))
+    for door in (g.door_up, g.door_down):
+        print("framing: %s %s, %d CRC errors"
+                % (door.port_name, door.codec.name, door.crc_errors))
+    print("devices: %d log overruns, %d CRC errors, %d bytes garbled"
+            % (after["log_overruns"], after["crc_errors"], after["garbled"]))
+    for t in g.threads:
+        t.kill()
+    for t in g.threads:
+        t.join(10)
+    request(ctl, "quit")
+    os.waitpid(pid, 0)
+    # The dispatcher thread never returns
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Exercise HifiMonitor against a small local MPD protocol stub.
+#
+# The stub accepts connections, answers every command (or command list)
+# with OK and records what it was sent.  With --idle-close it drops
+# connections that have been idle that long, as MPD does, to exercise
+# reconnection.
+#
+# Run from the top of the repository, on a machine with doord's
+# dependencies installed:
+#   python sim/mpdbench.py [--count 20] [--idle-close 1]
+
+from __future__ import print_function
+
+import optparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import doord
+
+class MPDStub(threading.Thread):
+    def __init__(self, idle_close):
+        super(MPDStub, self).__init__()
+        self.daemon = True
+        self.idle_close = idle_close
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.lock = threading.Lock()
+        self.commands = []
+        self.requests = 0
+        self.connections = 0
+
+    def serve(self, conn):
+        conn.settimeout(self.idle_close)
+        f = conn.makefile("rb")
+        conn.sendall("OK MPD 0.19.0\n")
+        in_list = False
+        try:
+            while True:
+                l = f.readline()
+                if l == "":
+                    break
+                l = l.rstrip("\n")
+                if l == "command_list_begin":
+                    in_list = True
+                    continue
+                with self.lock:
+                    if l != "command_list_end":
+                        self.commands.append(l)
+                    if not in_list or l == "command_list_end":
+                        self.requests += 1
+                if in_list and l != "command_list_end":
+                    continue
+                in_list = False
+                conn.sendall("OK\n")
+        except socket.timeout:
+            pass
+        f.close()
+        conn.close()
+
+    def run(self):
+        while True:
+            conn, addr = self.sock.accept()
+            with self.lock:
+                self.connections += 1
+            t = threading.Thread(target=self.serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+def main():
+    op = optparse.OptionParser()
+    op.add_option("--count", type="int", dest="count", default=20)
+    op.add_option("--idle-close", type="float", dest="idle_close", default=1)
+    (options, args) = op.parse_args()
+
+    stub = MPDStub(options.idle_close)
+    stub.start()
+    doord.MPD_HOST = "127.0.0.1"
+    doord.MPD_PORT = stub.port
+    hifi = doord.HifiMonitor(None)
+    hifi.daemon = True
+    hifi.start()
+
+    # A burst of commands, mostly redundant
+    t = time.time()
+    for i in range(options.count):
+        hifi.cmd("volume %d" % (50 + i))
+        hifi.cmd(["play", "stop"][i % 2])
+    while True:
+        with hifi:
+            if len(hifi.pending) == 0 and hifi.commands + hifi.collapsed \
+                    >= 2 * options.count:
+                break
+        time.sleep(0.001)
+    elapsed = time.time() - t
+    print("burst: %d commands queued, %d sent in %d requests, %d collapsed,"
+            " %.1fms" % (2 * options.count, hifi.commands, stub.requests,
+                hifi.collapsed, elapsed * 1000))
+
+    # Let the stub drop the connection, then check we reconnect
+    time.sleep(options.idle_close + 0.5)
+    batches = hifi.batches
+    t = time.time()
+    hifi.cmd("stop")
+    while hifi.batches == batches:
+        time.sleep(0.001)
+    print("after idle close: stop sent in %.1fms, %d connections"
+            % ((time.time() - t) * 1000, stub.connections))
+    print("last commands: %s" % stub.commands[-3:])
+    hifi.kill()
+    hifi.join(5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# Replay recorded DoorLock traffic to doord's DoorMonitor over a
+# pseudo-terminal and measure how fast it can read frames.
+#
+# The device side runs in a forked child writing to the pty master, so
+# the CPU time reported is that of the DoorMonitor reader only.
+#
+#   session: play the recording as a conversation, with DoorMonitor
+#            sending each host command and waiting for its response.
+#   stream:  send the recorded device frames back to back (repeated
+#            --count times) and read them with read_response().
+#
+# Run from the top of the repository, on a machine with doord's
+# dependencies installed:
+#   python sim/replay.py [--mode stream] [--count 200] [--baud 9600]
+
+from __future__ import print_function
+
+import optparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import serial
+import doord
+
+def load_traffic(path):
+    traffic = []
+    with open(path) as f:
+        for l in f:
+            l = l.rstrip("\n")
+            if l == "" or l[0] not in "<>":
+                continue
+            traffic.append((l[0], l[2:]))
+    return traffic
+
+# Counts read() calls made by the DoorMonitor
+class CountingSerial(object):
+    def __init__(self, ser):
+        self.ser = ser
+        self.reads = 0
+    def read(self, n=1):
+        self.reads += 1
+        return self.ser.read(n)
+    def inWaiting(self):
+        return self.ser.inWaiting()
+    def fileno(self):
+        return self.ser.fileno()
+    def write(self, data):
+        return self.ser.write(data)
+    def close(self):
+        self.ser.close()
+
+# Write frames to the pty master, paced at the given baud rate (8N1)
+def write_frames(fd, frames, baud):
+    for f in frames:
+        data = f + "\n"
+        if baud:
+            time.sleep(len(data) * 10.0 / baud)
+        os.write(fd, data)
+
+def device_stream(fd, traffic, count, baud):
+    frames = [frame for (d, frame) in traffic if d == '<']
+    for i in range(count):
+        write_frames(fd, frames, baud)
+
+# Answer each host command with the frames that follow it in the recording
+def device_session(fd, traffic, baud):
+    buf = ""
+    pending = []
+    for d, frame in traffic:
+        if d == '<':
+            pending.append(frame)
+            continue
+        write_frames(fd, pending, baud)
+        pending = []
+        while "\n" not in buf:
+            buf += os.read(fd, 256)
+        line, buf = buf.split("\n", 1)
+        if line != frame:
+            sys.stderr.write("Expected '%s' got '%s'\n" % (frame, line))
+    write_frames(fd, pending, baud)
+
+def fork_device(fn, *args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            fn(*args)
+        finally:
+            os._exit(0)
+    return pid
+
+def report(name, frames, elapsed, cpu, reads):
+    print("%s: %d frames in %.3fs, %.0f frames/s, %.1fus CPU/frame, %.3f reads/frame"
+            % (name, frames, elapsed, frames / elapsed, cpu * 1e6 / frames,
+                float(reads) / frames))
+
+def cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+def run_stream(mon, master, traffic, count, baud):
+    responses = len([f for (d, f) in traffic
+        if d == '<' and f[0] not in "#EY"]) * count
+    frames = len([f for (d, f) in traffic if d == '<']) * count
+    t0 = time.time()
+    c0 = cpu_time()
+    pid = fork_device(device_stream, master, traffic, count, baud)
+    got = 0
+    with mon:
+        while got < responses:
+            mon.read_response()
+            got += 1
+    elapsed = time.time() - t0
+    cpu = cpu_time() - c0
+    os.waitpid(pid, 0)
+    report("stream", frames, elapsed, cpu, mon.ser.reads)
+
+def run_session(mon, master, traffic, baud):
+    frames = len(traffic)
+    t0 = time.time()
+    c0 = cpu_time()
+    pid = fork_device(device_session, master, traffic, baud)
+    with mon:
+        for d, frame in traffic:
+            if d == '>':
+                mon.do_cmd(frame[:-4])
+    elapsed = time.time() - t0
+    cpu = cpu_time() - c0
+    os.waitpid(pid, 0)
+    report("session", frames, elapsed, cpu, mon.ser.reads)
+
+def main():
+    op = optparse.OptionParser()
+    op.add_option("--traffic", dest="traffic",
+            default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                "doorlock-traffic.txt"))
+    op.add_option("--mode", type="choice", choices=["stream", "session"],
+            dest="mode", default="stream")
+    op.add_option("--count", type="int", dest="count", default=200)
+    op.add_option("--baud", type="int", dest="baud", default=0,
+            help="pace device output at this line rate (default: unpaced)")
+    (options, args) = op.parse_args()
+
+    traffic = load_traffic(options.traffic)
+    master, slave = os.openpty()
+    ser = serial.Serial(os.ttyname(slave), 9600, timeout=doord.SERIAL_POLL_PERIOD)
+    mon = doord.DoorMonitor(None, "replay")
+    mon.ser = CountingSerial(ser)
+    if options.mode == "stream":
+        run_stream(mon, master, traffic, options.count, options.baud)
+    else:
+        run_session(mon, master, traffic, options.baud)
+    ser.close()
+
+if __name__ == "__main__":
+    main()
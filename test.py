@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+
+# Tests for doord.  Run from the top of the repository, on a machine with
+# doord's dependencies installed:
+#   python test.py
+
+import binascii
+import os
+import serial
+import time
+import tty
+import unittest
+
+import doord
+
+# Neighbour table messages from the kernel's RTNLGRP_NEIGH group, as
+# received by NeighMonitor.  Captured while running:
+#   ip neigh add 192.0.2.77 lladdr 02:00:5e:00:53:4d dev eth0 nud reachable
+#   ip neigh add fd00::77 lladdr 02:00:5e:00:53:4e dev eth0 nud reachable
+#   ip neigh del 192.0.2.77 dev eth0
+#   ip neigh del fd00::77 dev eth0
+NEIGH_MSGS = [binascii.unhexlify(m) for m in (
+    "4c0000001c000000000000008a52000002000000040000000200000108000100c000024d"
+    "0a00020002005e00534d0000080004000000000014000300000000000000000000000000"
+    "02000000",
+    "580000001c000000000000008b5200000a000000040000000200000114000100fd000000"
+    "0000000000000000000000770a00020002005e00534e0000080004000000000014000300"
+    "00000000000000000000000002000000",
+    "400000001c000000000000008c52000002000000040000002000000108000100c000024d"
+    "080004000000000014000300c9000000c9000000c900000001000000",
+    "400000001d000000000000000000000002000000040000002000000108000100c000024d"
+    "080004000000000014000300c9000000c9000000c900000000000000",
+    "4c0000001c000000000000008d5200000a000000040000002000000114000100fd000000"
+    "000000000000000000000077080004000000000014000300c9000000c9000000c9000000"
+    "01000000",
+    "4c0000001d00000000000000000000000a000000040000002000000114000100fd000000"
+    "000000000000000000000077080004000000000014000300c9000000c9000000c9000000"
+    "00000000")]
+
+class TestParseNeigh(unittest.TestCase):
+    def testAdd(self):
+        self.assertEqual(doord.parse_neigh(NEIGH_MSGS[0]),
+                [(doord.RTM_NEWNEIGH, "192.0.2.77", "02:00:5e:00:53:4d", 0x02)])
+
+    def testDelete(self):
+        # The kernel marks the entry failed, then deletes it
+        self.assertEqual(doord.parse_neigh(NEIGH_MSGS[2]),
+                [(doord.RTM_NEWNEIGH, "192.0.2.77", None, doord.NUD_FAILED)])
+        self.assertEqual(doord.parse_neigh(NEIGH_MSGS[3]),
+                [(doord.RTM_DELNEIGH, "192.0.2.77", None, doord.NUD_FAILED)])
+
+    def testIPv6Ignored(self):
+        for i in (1, 4, 5):
+            self.assertEqual(doord.parse_neigh(NEIGH_MSGS[i]), [])
+
+    def testSeveral(self):
+        events = doord.parse_neigh("".join(NEIGH_MSGS))
+        self.assertEqual([(t, ip) for (t, ip, mac, state) in events],
+                [(doord.RTM_NEWNEIGH, "192.0.2.77"),
+                    (doord.RTM_NEWNEIGH, "192.0.2.77"),
+                    (doord.RTM_DELNEIGH, "192.0.2.77")])
+
+    def testTruncated(self):
+        self.assertEqual(doord.parse_neigh(NEIGH_MSGS[0][:40]), [])
+
+# A DoorMonitor attached to one end of a pseudo-terminal, in sync
+class DoorPty(object):
+    def __init__(self):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        name = os.ttyname(slave)
+        self.door = doord.DoorMonitor(None, name[len("/dev/"):])
+        self.door.ser = serial.Serial(name, doord.SERIAL_BAUD, timeout=1)
+        os.close(slave)
+        self.door.features = ""
+        self.door.sync = True
+        # Short, so that a missed notification fails rather than hangs
+        self.door.next_ping = time.time() + 5
+
+    def send(self, msgs):
+        os.write(self.master, "".join(self.door.codec.encode(m) for m in msgs))
+
+    def close(self):
+        self.door.ser.close()
+        os.close(self.master)
+
+class TestDoorMonitor(unittest.TestCase):
+    def setUp(self):
+        self.pty = DoorPty()
+
+    def tearDown(self):
+        self.pty.close()
+
+    def testEventWithResponse(self):
+        door = self.pty.door
+        # The firmware acks a remote unlock, then reports the door event
+        self.pty.send(["A0", "E0"])
+        self.assertEqual(door.do_cmd("U0"), "A0")
+        t = time.time()
+        with door:
+            door.wait_event()
+        self.assertTrue(door.seen_event)
+        self.assertTrue(time.time() - t < 1)
+
+    def testKeypadWithResponse(self):
+        door = self.pty.door
+        self.pty.send(["A0", "Y0#"])
+        self.assertEqual(door.do_cmd("U0"), "A0")
+        with door:
+            door.wait_event()
+        self.assertEqual(door.seen_kp, "#")
+
+class TestHifiMonitor(unittest.TestCase):
+    def setUp(self):
+        self.hifi = doord.HifiMonitor(None)
+
+    def queue(self, cmds):
+        for cmd in cmds:
+            self.hifi.cmd(cmd)
+        return self.hifi.pending
+
+    def testNextKept(self):
+        self.assertEqual(self.queue(["next", "next", "prev"]),
+                ["next", "next", "prev"])
+
+    def testToggleKept(self):
+        self.assertEqual(self.queue(["toggle", "toggle"]),
+                ["toggle", "toggle"])
+        self.assertEqual(self.hifi.collapsed, 0)
+
+    def testReplaced(self):
+        self.assertEqual(self.queue(["play", "volume 30", "repeat on",
+                    "toggle", "volume 50", "stop", "repeat on"]),
+                ["toggle", "volume 50", "stop", "repeat on"])
+
+    def testRelativeVolume(self):
+        self.assertEqual(self.queue(["volume +5", "volume +5"]),
+                ["volume +5", "volume +5"])
+        self.assertEqual(self.queue(["volume 30"]), ["volume 30"])
+
+if __name__ == '__main__':
+    unittest.main()